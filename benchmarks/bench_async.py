@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# Load test of concurrent commands against a stub upstream with latency.
+# Each "command" is one Fixer request, issued either from a fixed pool of
+# worker threads blocking on aio.run_sync, as the thread based bot core
+# calls synchronized handlers, or as coroutines on the single shared event
+# loop, as an asyncio based core would.
+#
+#   python -m benchmarks.bench_async [--latency SEC] [--workers N]
+#                                    [--connections N]
+#                                    [--concurrency N [N ...]]
+#
+# --workers bounds the thread side and --connections, the per host
+# connection limit of the shared async client, bounds both.
+import argparse
+import asyncio
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from benchmarks.stub_server import StubServer, json_route
+from sarah_plugins import aio
+from sarah_plugins.currency import FixerClient
+from typing import Callable, Sequence, Tuple
+
+
+def summarize(elapsed: float,
+              latencies: Sequence[float]) -> Tuple[float, float, float]:
+    latencies = sorted(latencies)
+    return (len(latencies) / elapsed,
+            statistics.median(latencies) * 1000,
+            latencies[int(len(latencies) * 0.95) - 1] * 1000)
+
+
+def run_threads(client: FixerClient,
+                concurrency: int,
+                workers: int) -> Tuple[float, float, float]:
+    # Every command is submitted at once; latency includes queueing for a
+    # free worker, which is what a user waiting for a reply sees.
+    def command(submitted_at: float) -> float:
+        aio.run_sync(client.get_current_rate("USD"))
+        return time.perf_counter() - submitted_at
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        latencies = list(executor.map(command,
+                                      [started_at] * concurrency))
+    return summarize(time.perf_counter() - started_at, latencies)
+
+
+def run_coroutines(client: FixerClient,
+                   concurrency: int) -> Tuple[float, float, float]:
+    async def command(submitted_at: float) -> float:
+        await client.get_current_rate("USD")
+        return time.perf_counter() - submitted_at
+
+    async def run_all() -> Sequence[float]:
+        return await asyncio.gather(*[command(started_at)
+                                      for _ in range(concurrency)])
+
+    started_at = time.perf_counter()
+    latencies = aio.run_sync(run_all())
+    return summarize(time.perf_counter() - started_at, latencies)
+
+
+def report(label: str, run: Callable[[], Tuple[float, float, float]]) -> None:
+    throughput, median, p95 = run()
+    print("%-26s %10.1f %12.1f %12.1f" % (label, throughput, median, p95))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--latency', type=float, default=0.2)
+    parser.add_argument('--workers', type=int, default=10)
+    parser.add_argument('--connections', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, nargs='+',
+                        default=[10, 50, 200, 500])
+    args = parser.parse_args()
+
+    routes = {'/latest': json_route({'base': "USD", 'rates': {'JPY': 120.1}})}
+    with StubServer(routes, delay=args.latency) as server:
+        aio.configure(limit_per_host=args.connections)
+        client = FixerClient(base_url=server.base_url)
+        # Open keep-alive connections before measuring.
+        aio.run_sync(client.get_current_rate("USD"))
+
+        print("upstream latency %.0f ms, %d worker threads, "
+              "%d async connections" % (args.latency * 1000,
+                                        args.workers,
+                                        args.connections))
+        print("%-26s %10s %12s %12s" % ("", "cmd/sec", "median ms",
+                                        "p95 ms"))
+        for concurrency in args.concurrency:
+            report("threads   x%d" % concurrency,
+                   lambda: run_threads(client,
+                                       concurrency,
+                                       args.workers))
+            report("coroutines x%d" % concurrency,
+                   lambda: run_coroutines(client, concurrency))
+
+        aio.run_sync(aio.get_client().close())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# Compare render latency of the in-process chart backend with the plot.ly
+# upload round trip used by default.
+#
+#   python -m benchmarks.bench_chart [--days N] [--repeat N] [--plotly]
+#
+# --plotly uploads to plot.ly, so it needs network access and plotly
+# credentials configured in ~/.plotly. Without it only the local backend
+# is measured.
+import argparse
+import random
+import shutil
+import statistics
+import tempfile
+import time
+from datetime import date, timedelta
+from sarah_plugins.chart import ChartRenderer, LocalStorage, draw_bars, \
+    draw_candlestick, rendered_cache
+from typing import Callable, Dict, Sequence
+
+
+def generate_history(days: int) -> Dict[str, Sequence]:
+    today = date.today()
+    history = {'dates': [], 'open': [], 'high': [], 'low': [], 'close': [],
+               'volume': []}
+    price = 100.0
+    for i in range(days):
+        open_price = price
+        price = max(1.0, price + random.uniform(-3, 3))
+        history['dates'].append((today - timedelta(days=i)).isoformat())
+        history['open'].append(round(open_price, 2))
+        history['close'].append(round(price, 2))
+        history['high'].append(round(max(open_price, price) + 1, 2))
+        history['low'].append(round(min(open_price, price) - 1, 2))
+        history['volume'].append(random.randint(10000, 100000))
+    return history
+
+
+def measure(label: str, repeat: int, run: Callable[[], object]) -> None:
+    timings = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        run()
+        timings.append((time.perf_counter() - started_at) * 1000)
+    print("%-28s median %9.2f ms   min %9.2f ms" % (
+        label, statistics.median(timings), min(timings)))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--plotly', action='store_true')
+    args = parser.parse_args()
+
+    h = generate_history(args.days)
+    candle_inputs = (h['dates'], h['open'], h['high'], h['low'], h['close'])
+
+    measure("local candlestick render", args.repeat,
+            lambda: draw_candlestick(*candle_inputs))
+    measure("local volume render", args.repeat,
+            lambda: draw_bars(h['dates'], h['volume']))
+
+    directory = tempfile.mkdtemp()
+    try:
+        renderer = ChartRenderer(LocalStorage(directory, "http://localhost/"))
+        rendered_cache.clear()
+        measure("local render + save (cold)", 1,
+                lambda: renderer.candlestick(*candle_inputs))
+        measure("local render + save (cached)", args.repeat,
+                lambda: renderer.candlestick(*candle_inputs))
+    finally:
+        shutil.rmtree(directory)
+
+    if args.plotly:
+        from plotly.graph_objs import Data, Scatter
+        from plotly.plotly import plotly
+        from plotly.tools import FigureFactory
+        measure("plot.ly candlestick upload", args.repeat,
+                lambda: plotly.plot(
+                    FigureFactory.create_candlestick(h['open'],
+                                                     h['high'],
+                                                     h['low'],
+                                                     h['close'],
+                                                     dates=h['dates']),
+                    filename="barchart/bench",
+                    auto_open=False))
+        measure("plot.ly volume upload", args.repeat,
+                lambda: plotly.plot(Data([Scatter(x=h['dates'],
+                                                  y=h['volume'])]),
+                                    auto_open=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+# End-to-end benchmark of command handlers against recorded upstream
+# fixtures replayed by a local stub server. No network access is needed.
+#
+#   python -m benchmarks.bench_handlers [SCENARIO ...] [--iterations N]
+#          [--concurrency N] [--warm] [--save NAME] [--compare NAME]
+#
+# Scenarios are hateb, stock, weather and flickr. Each iteration calls the
+# registered (sync) handler exactly as the bot does. By default plugin
+# caches are cleared before every call so the whole path is measured:
+# upstream request, decode, computation and message building. --warm keeps
+# caches to measure the cached path instead.
+#
+# Reported per scenario:
+#   median/p95 ms  latency of one command run alone
+#   cmd/sec        throughput with --concurrency commands in flight
+#   peak KiB       peak traced memory while handling one command
+#   retained KiB   memory still referenced after the command returned
+#
+# --save stores the results in .benchmarks/NAME.json and --compare prints
+# them next to a stored run, so a change can be measured against the
+# commit before it:
+#
+#   git stash && python -m benchmarks.bench_handlers --save before
+#   git stash pop && python -m benchmarks.bench_handlers --compare before
+import argparse
+import gc
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from urllib.parse import parse_qs
+from benchmarks.stub_server import StubServer, json_route
+from typing import Callable, Dict, Sequence, Tuple
+
+FIXTURE_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+BASELINE_DIR = ".benchmarks"
+
+
+def load_fixture(name: str) -> bytes:
+    with open(os.path.join(FIXTURE_DIR, name), 'rb') as f:
+        return f.read()
+
+
+def rebase_history(content: bytes) -> bytes:
+    # The recorded history ends on a fixed day. Shift it so that the last
+    # trading day is yesterday and the requested window is always covered.
+    decoded_content = json.loads(content.decode())
+    results = decoded_content['results']
+    latest = max(date(*map(int, r['tradingDay'].split("-")))
+                 for r in results)
+    shift = date.today() - timedelta(days=1) - latest
+    for r in results:
+        day = date(*map(int, r['tradingDay'].split("-"))) + shift
+        r['tradingDay'] = day.isoformat()
+        r['timestamp'] = "%sT00:00:00-05:00" % day.isoformat()
+    return json.dumps(decoded_content).encode()
+
+
+def create_routes() -> Dict:
+    history = rebase_history(load_fixture("barchart_history.json"))
+    geo_location = load_fixture("flickr_geo_location.json")
+    geo_no_location = load_fixture("flickr_geo_no_location.json")
+    interestingness = load_fixture("flickr_interestingness.json")
+    json_headers = {'Content-Type': "application/json"}
+
+    def flickr(handler) -> Tuple[int, Dict, bytes]:
+        # flickrapi POSTs every method to the same REST endpoint.
+        params = parse_qs(handler.body.decode())
+        method = params.get('method', [""])[0]
+        if method == "flickr.interestingness.getList":
+            return 200, json_headers, interestingness
+        elif method == "flickr.photos.geo.getLocation":
+            # Like the real list, only some photos have a location.
+            photo_id = int(params['photo_id'][0])
+            return (200,
+                    json_headers,
+                    geo_location if photo_id % 3 else geo_no_location)
+        return 404, json_headers, b"{}"
+
+    return {
+        '/hotentry/it.rss': (200,
+                             {'Content-Type': "application/rss+xml; "
+                                              "charset=utf-8"},
+                             load_fixture("hatena_hotentry_it.rss")),
+        '/gists': json_route({'id': "0123456789abcdef",
+                              'html_url': "https://gist.github.com/"
+                                          "0123456789abcdef"},
+                             201),
+        '/getHistory.json': (200, json_headers, history),
+        '/free/v2/weather.ashx': (200,
+                                  json_headers,
+                                  load_fixture("worldweather_tokyo.json")),
+        '/services/rest/': flickr}
+
+
+class Scenario(object):
+    # prepare() runs before every iteration, outside of the measurement,
+    # and its return value is passed to run().
+    def __init__(self,
+                 run: Callable[[object], object],
+                 prepare: Callable[[], object]=lambda: None):
+        self.run = run
+        self.prepare = prepare
+
+
+def command_message(text: str):
+    from sarah.bot.values import CommandMessage
+    return CommandMessage(original_text=text, text=text, sender="bench")
+
+
+def hateb_scenario(base_url: str, work_dir: str, warm: bool) -> Scenario:
+    from sarah_plugins import hateb
+
+    config = dict()
+
+    def new_hateb() -> None:
+        fd, path = tempfile.mkstemp(suffix=".sqlite3", dir=work_dir)
+        os.close(fd)
+        config['gist_cache_path'] = path
+        hateb.hateb = hateb.Hateb(gist_cache_path=path,
+                                  gist_api_url=base_url + "gists",
+                                  feed_base_url=base_url)
+
+    new_hateb()
+    msg = command_message("it")
+    return Scenario(lambda _: hateb.slack_hateb(msg, config),
+                    (lambda: None) if warm else new_hateb)
+
+
+def stock_scenario(base_url: str, work_dir: str, warm: bool) -> Scenario:
+    from sarah_plugins import barchart, chart
+
+    config = {'api_key': "bench",
+              'base_url': base_url,
+              'timeseries_path': os.path.join(work_dir, "timeseries.sqlite3"),
+              'chart_storage': "local",
+              'chart_dir': os.path.join(work_dir, "charts"),
+              'chart_base_url': "http://localhost/charts/"}
+
+    def clear() -> None:
+        barchart.history_cache.clear()
+        chart.rendered_cache.clear()
+
+    msg = command_message("AAPL 1y")
+    return Scenario(lambda _: barchart.slack_stock_price(msg, config),
+                    (lambda: None) if warm else clear)
+
+
+def weather_scenario(base_url: str, work_dir: str, warm: bool) -> Scenario:
+    from sarah_plugins import worldweather
+
+    config = {'api_key': "bench",
+              'api_url': base_url + "free/v2/weather.ashx"}
+    msg = command_message("Tokyo")
+    return Scenario(lambda _: worldweather.slack_weather(msg, config),
+                    ((lambda: None) if warm else
+                     worldweather.current_condition_cache.clear))
+
+
+def flickr_scenario(base_url: str, work_dir: str, warm: bool) -> Scenario:
+    from sarah_plugins import flickr
+
+    config = {'api_key': "bench",
+              'api_secret': "bench",
+              'rest_url': base_url + "services/rest/",
+              'location_cache_path': os.path.join(work_dir,
+                                                  "flickr.sqlite3")}
+
+    def new_location_cache() -> Dict:
+        fd, path = tempfile.mkstemp(suffix=".sqlite3", dir=work_dir)
+        os.close(fd)
+        return dict(config, location_cache_path=path)
+
+    return Scenario(flickr.interesting_pictures,
+                    (lambda: config) if warm else new_location_cache)
+
+
+SCENARIOS = {'hateb': hateb_scenario,
+             'stock': stock_scenario,
+             'weather': weather_scenario,
+             'flickr': flickr_scenario}
+
+
+def measure_latency(scenario: Scenario, iterations: int) -> Sequence[float]:
+    latencies = []
+    for _ in range(iterations):
+        state = scenario.prepare()
+        started_at = time.perf_counter()
+        scenario.run(state)
+        latencies.append(time.perf_counter() - started_at)
+    return latencies
+
+
+def measure_throughput(scenario: Scenario,
+                       iterations: int,
+                       concurrency: int) -> float:
+    def command(_) -> None:
+        scenario.run(scenario.prepare())
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(command, range(iterations)))
+    return iterations / (time.perf_counter() - started_at)
+
+
+def measure_memory(scenario: Scenario,
+                   iterations: int) -> Tuple[float, float]:
+    peaks = []
+    retained = []
+    tracemalloc.start()
+    try:
+        for _ in range(iterations):
+            state = scenario.prepare()
+            # Also resets the peak
+            tracemalloc.clear_traces()
+            scenario.run(state)
+            _, peak = tracemalloc.get_traced_memory()
+            # Figures and parsed documents are freed by the cycle collector
+            gc.collect()
+            current, _ = tracemalloc.get_traced_memory()
+            peaks.append(peak)
+            retained.append(current)
+    finally:
+        tracemalloc.stop()
+    return (statistics.median(peaks) / 1024,
+            statistics.median(retained) / 1024)
+
+
+def run_scenario(name: str,
+                 base_url: str,
+                 work_dir: str,
+                 args: argparse.Namespace) -> Dict[str, float]:
+    scenario = SCENARIOS[name](base_url, work_dir, args.warm)
+    # Warm up connections, imports and the event loop.
+    for _ in range(2):
+        scenario.run(scenario.prepare())
+
+    latencies = sorted(measure_latency(scenario, args.iterations))
+    throughput = measure_throughput(scenario,
+                                    args.iterations,
+                                    args.concurrency)
+    peak_kib, retained_kib = measure_memory(scenario,
+                                            min(args.iterations, 10))
+
+    return {'median_ms': statistics.median(latencies) * 1000,
+            'p95_ms': latencies[max(0, int(len(latencies) * 0.95) - 1)] *
+            1000,
+            'cmd_per_sec': throughput,
+            'peak_kib': peak_kib,
+            'retained_kib': retained_kib}
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return "unknown"
+
+
+COLUMNS = (('median_ms', "median ms"),
+           ('p95_ms', "p95 ms"),
+           ('cmd_per_sec', "cmd/sec"),
+           ('peak_kib', "peak KiB"),
+           ('retained_kib', "retained KiB"))
+
+
+def print_results(results: Dict[str, Dict[str, float]],
+                  baseline: Dict[str, Dict[str, float]]=None) -> None:
+    print("%-10s" % "" + "".join("%16s" % title for _, title in COLUMNS))
+    for name, result in sorted(results.items()):
+        cells = []
+        for key, _ in COLUMNS:
+            cell = "%.1f" % result[key]
+            previous = (baseline or {}).get(name, {}).get(key, None)
+            if previous:
+                cell += " (%+.0f%%)" % ((result[key] - previous) / previous *
+                                        100)
+            cells.append("%16s" % cell)
+        print("%-10s" % name + "".join(cells))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('scenarios', nargs='*', metavar='SCENARIO')
+    parser.add_argument('--iterations', type=int, default=30)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--warm', action='store_true')
+    parser.add_argument('--save', metavar='NAME')
+    parser.add_argument('--compare', metavar='NAME')
+    parser.add_argument('--baseline-dir', default=BASELINE_DIR)
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error("unknown scenario %s, choose from %s" % (
+                name, ", ".join(sorted(SCENARIOS.keys()))))
+
+    baseline = None
+    if args.compare:
+        with open(os.path.join(args.baseline_dir,
+                               args.compare + ".json")) as f:
+            stored = json.load(f)
+        print("comparing with %s (revision %s, %s)" % (
+            args.compare, stored['revision'], stored['created_at']))
+        if stored['warm'] != args.warm:
+            print("warning: stored run used --warm=%s" % stored['warm'])
+        baseline = stored['results']
+
+    results = dict()
+    work_dir = tempfile.mkdtemp()
+    try:
+        with StubServer(create_routes()) as server:
+            for name in args.scenarios or sorted(SCENARIOS.keys()):
+                try:
+                    results[name] = run_scenario(name,
+                                                 server.base_url,
+                                                 work_dir,
+                                                 args)
+                except ImportError as e:
+                    print("skipping %s: %s" % (name, e))
+    finally:
+        shutil.rmtree(work_dir)
+
+    print_results(results, baseline)
+
+    if args.save:
+        os.makedirs(args.baseline_dir, exist_ok=True)
+        path = os.path.join(args.baseline_dir, args.save + ".json")
+        with open(path, 'w') as f:
+            json.dump({'revision': git_revision(),
+                       'created_at': time.strftime("%Y-%m-%d %H:%M:%S"),
+                       'python': platform.python_version(),
+                       'warm': args.warm,
+                       'iterations': args.iterations,
+                       'concurrency': args.concurrency,
+                       'results': results},
+                      f,
+                      indent=2,
+                      sort_keys=True)
+        print("saved to %s" % path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# Compare parse time and memory of hateb's streaming RSS parser with
+# feedparser on recorded Hatena feeds.
+#
+#   python -m benchmarks.bench_hateb_parser [--top N] [--repeat N]
+#
+# Every benchmarks/fixtures/hatena_*.rss is parsed three ways: feedparser
+# as before, the fast parser reading the whole feed and the fast parser
+# stopping after the top N entries.
+import argparse
+import glob
+import os
+import statistics
+import time
+import tracemalloc
+import feedparser
+from sarah_plugins.hateb import Entry, parse_hatena_rss
+from benchmarks.bench_handlers import FIXTURE_DIR
+from typing import Callable, Sequence, Tuple
+
+
+def parse_with_feedparser(content: bytes) -> Sequence[Entry]:
+    # What Hateb.read_feed did before
+    result = feedparser.parse(content)
+    return [Entry(e['link'],
+                  e['title'],
+                  e['summary'],
+                  int(e['hatena_bookmarkcount']))
+            for e in result['entries']]
+
+
+def measure(parse: Callable[[], object], repeat: int) -> Tuple[float, float]:
+    timings = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        parse()
+        timings.append(time.perf_counter() - started_at)
+
+    tracemalloc.start()
+    try:
+        parse()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return statistics.median(timings) * 1000, peak / 1024
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    print("%-28s %-14s %10s %10s" % ("", "", "median ms", "peak KiB"))
+    for path in sorted(glob.glob(os.path.join(FIXTURE_DIR, "hatena_*.rss"))):
+        with open(path, 'rb') as f:
+            content = f.read()
+
+        expected = parse_with_feedparser(content)
+        if parse_hatena_rss(content) != expected:
+            raise SystemExit("%s: parsers disagree" % path)
+
+        cases = (("feedparser", lambda: parse_with_feedparser(content)),
+                 ("fast", lambda: parse_hatena_rss(content)),
+                 ("fast top %d" % args.top,
+                  lambda: parse_hatena_rss(content, args.top)))
+        baseline_ms = None
+        for label, parse in cases:
+            median_ms, peak_kib = measure(parse, args.repeat)
+            baseline_ms = baseline_ms or median_ms
+            print("%-28s %-14s %10.3f %10.1f  (%.0f%% time)" % (
+                os.path.basename(path), label, median_ms, peak_kib,
+                median_ms / baseline_ms * 100))
+
+
+if __name__ == '__main__':
+    main()
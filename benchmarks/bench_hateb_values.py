@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+# Compare memory and change detection cost of hateb's tuple based Entry and
+# fingerprinted Feed with the dict backed ValueObjects they replaced.
+#
+#   python -m benchmarks.bench_hateb_values [--categories N] [--snapshots N]
+#
+# Entries come from the recorded hot entry RSS fixture. Every snapshot gets
+# its own copies of the strings, as each retrieval parses them anew.
+import argparse
+import gc
+import hashlib
+import statistics
+import time
+import tracemalloc
+import feedparser
+from sarah import ValueObject
+from sarah_plugins.hateb import Entry, Feed, Hateb
+from benchmarks.bench_handlers import load_fixture
+from typing import Callable, Sequence, Tuple
+
+
+class LegacyEntry(ValueObject):
+    def __init__(self,
+                 link: str,
+                 title: str,
+                 summary: str,
+                 bookmark_count: int):
+        pass
+
+    @property
+    def link(self) -> str:
+        return self['link']
+
+    @property
+    def title(self) -> str:
+        return self['title']
+
+    @property
+    def summary(self) -> str:
+        return self['summary']
+
+    @property
+    def bookmark_count(self) -> int:
+        return self['bookmark_count']
+
+
+class LegacyFeed(ValueObject):
+    def __init__(self,
+                 category: str,
+                 entries: Sequence[LegacyEntry]):
+        pass
+
+    @property
+    def category(self) -> str:
+        return self['category']
+
+    @property
+    def entries(self) -> Sequence[LegacyEntry]:
+        return self['entries']
+
+
+def legacy_digest(feed: LegacyFeed) -> str:
+    # What Hateb.is_new computed on every call before
+    return hashlib.sha1(Hateb.gist_content(feed).encode()).hexdigest()
+
+
+def copy(value: str) -> str:
+    return value.encode().decode()
+
+
+def build(entry_class: Callable,
+          feed_class: Callable,
+          rows: Sequence[Tuple[str, str, str, int]],
+          categories: int,
+          snapshots: int) -> list:
+    return [feed_class("category%d" % c,
+                       [entry_class(copy(link),
+                                    copy(title),
+                                    copy(summary),
+                                    count + s)
+                        for link, title, summary, count in rows])
+            for c in range(categories)
+            for s in range(snapshots)]
+
+
+def measure_memory(build_feeds: Callable[[], list]) -> Tuple[float, list]:
+    gc.collect()
+    tracemalloc.start()
+    try:
+        feeds = build_feeds()
+        gc.collect()
+        current, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return current / 1024, feeds
+
+
+def measure_time(run: Callable[[], object], repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - started_at)
+    return statistics.median(timings) * 1000000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--categories', type=int, default=10)
+    parser.add_argument('--snapshots', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    parsed = feedparser.parse(load_fixture("hatena_hotentry_it.rss"))
+    rows = [(e['link'], e['title'], e['summary'],
+             int(e['hatena_bookmarkcount']))
+            for e in parsed['entries']]
+
+    print("%d categories x %d snapshots x %d entries" % (
+        args.categories, args.snapshots, len(rows)))
+
+    strings_kib, strings = measure_memory(
+        lambda: build(lambda *fields: fields, lambda _, entries: entries,
+                      rows, args.categories, args.snapshots))
+    del strings
+    legacy_kib, legacy_feeds = measure_memory(
+        lambda: build(LegacyEntry, LegacyFeed, rows, args.categories,
+                      args.snapshots))
+    compact_kib, compact_feeds = measure_memory(
+        lambda: build(Entry, Feed, rows, args.categories, args.snapshots))
+    print("%-36s %12s %12s" % ("", "ValueObject", "tuple"))
+    print("%-36s %12.1f %12.1f  (%.0f%%)" % (
+        "memory held, KiB", legacy_kib, compact_kib,
+        compact_kib / legacy_kib * 100))
+    print("%-36s %12.1f %12.1f  (%.0f%%)" % (
+        "  of which objects, not strings", legacy_kib - strings_kib,
+        compact_kib - strings_kib,
+        (compact_kib - strings_kib) / (legacy_kib - strings_kib) * 100))
+
+    # The same strings are shared by both kinds of objects from here on.
+    legacy_feed = LegacyFeed("it", [LegacyEntry(*row) for row in rows])
+    compact_feed = Feed("it", [Entry(*row) for row in rows])
+    print("%-36s %12.1f %12.1f" % (
+        "build one feed, us",
+        measure_time(lambda: LegacyFeed(
+            "it", [LegacyEntry(*row) for row in rows]), args.repeat),
+        measure_time(lambda: Feed(
+            "it", [Entry(*row) for row in rows]), args.repeat)))
+
+    cached_digest = legacy_digest(legacy_feed)
+    cached_fingerprint = compact_feed.fingerprint
+    print("%-36s %12.2f %12.2f" % (
+        "is_new check, us",
+        measure_time(lambda: legacy_digest(legacy_feed) != cached_digest,
+                     args.repeat),
+        measure_time(lambda: compact_feed.fingerprint != cached_fingerprint,
+                     args.repeat)))
+
+    other_legacy = LegacyFeed("it", [LegacyEntry(*row) for row in rows])
+    other_compact = Feed("it", [Entry(*row) for row in rows])
+    print("%-36s %12.2f %12.2f" % (
+        "compare two equal feeds, us",
+        measure_time(lambda: legacy_feed == other_legacy, args.repeat),
+        measure_time(lambda: compact_feed == other_compact, args.repeat)))
+
+    del legacy_feeds, compact_feeds
+
+
+if __name__ == '__main__':
+    main()
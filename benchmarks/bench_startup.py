@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# Import time and resident memory of each plugin, as paid on bot startup.
+#
+#   python -m benchmarks.bench_startup [PLUGIN ...] [--repeat N]
+#
+# Every measurement runs in a fresh interpreter that first imports the bot
+# itself (sarah.bot.slack and sarah.bot.hipchat), so the numbers are what
+# loading the plugin adds on top of it. Also lists which heavy third party
+# packages the import pulled in; those should only appear once a command
+# or schedule that needs them has run.
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from typing import Dict
+
+PLUGINS = ('barchart', 'capture_image', 'currency', 'flickr', 'hateb',
+           'localtime', 'metrics_summary', 'room_temp', 'worldweather')
+
+HEAVY_MODULES = ('aiohttp', 'plotly', 'feedparser', 'flickrapi',
+                 'matplotlib', 'numpy')
+
+CHILD = """
+import json, sys, time, importlib
+
+def rss_kib():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+
+import sarah.bot.slack, sarah.bot.hipchat
+before_kib = rss_kib()
+started_at = time.perf_counter()
+try:
+    importlib.import_module('sarah_plugins.' + sys.argv[1])
+except ImportError as e:
+    print(json.dumps({'error': str(e)}))
+    sys.exit()
+elapsed = time.perf_counter() - started_at
+print(json.dumps({'import_ms': elapsed * 1000,
+                  'rss_kib': rss_kib() - before_kib,
+                  'heavy': [m for m in json.loads(sys.argv[2])
+                            if m in sys.modules]}))
+"""
+
+
+def measure(plugin: str) -> Dict:
+    output = subprocess.check_output(
+        [sys.executable, "-c", CHILD, plugin, json.dumps(HEAVY_MODULES)])
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('plugins', nargs='*', metavar='PLUGIN')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    for name in args.plugins:
+        if name not in PLUGINS:
+            parser.error("unknown plugin %s, choose from %s" % (
+                name, ", ".join(PLUGINS)))
+
+    print("%-16s %12s %12s  %s" % ("", "import ms", "RSS KiB",
+                                   "heavy modules loaded"))
+    for plugin in args.plugins or PLUGINS:
+        results = [measure(plugin) for _ in range(args.repeat)]
+        if 'error' in results[0]:
+            print("%-16s skipped: %s" % (plugin, results[0]['error']))
+            continue
+        print("%-16s %12.1f %12d  %s" % (
+            plugin,
+            statistics.median(r['import_ms'] for r in results),
+            statistics.median(r['rss_kib'] for r in results),
+            ", ".join(results[0]['heavy']) or "-"))
+
+
+if __name__ == '__main__':
+    main()
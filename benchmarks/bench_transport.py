@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+# Compare module-level requests.get, which opens a new connection per call,
+# with the pooled keep-alive client in sarah_plugins.transport.
+#
+#   python -m benchmarks.bench_transport [--requests N] [--threads N]
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from benchmarks.stub_server import StubServer, json_route
+from sarah_plugins.transport import HttpClient
+from typing import Callable
+
+
+def measure(get: Callable[[str], requests.Response],
+            url: str,
+            count: int,
+            threads: int) -> float:
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for response in executor.map(lambda _: get(url), range(count)):
+            response.raise_for_status()
+    return count / (time.perf_counter() - started_at)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+
+    routes = {'/latest': json_route({'base': "USD", 'rates': {'JPY': 120.1}})}
+    with StubServer(routes) as server:
+        url = server.base_url + "latest"
+
+        connections = server.connection_count
+        before = measure(requests.get, url, args.requests, args.threads)
+        before_connections = server.connection_count - connections
+
+        client = HttpClient(pool_maxsize=args.threads)
+        connections = server.connection_count
+        after = measure(client.get, url, args.requests, args.threads)
+        after_connections = server.connection_count - connections
+        client.close()
+
+    print("%-18s %10s %12s" % ("", "req/sec", "connections"))
+    print("%-18s %10.1f %12d" % ("requests.get", before, before_connections))
+    print("%-18s %10.1f %12d" % ("transport", after, after_connections))
+    print("speedup: %.2fx" % (after / before))
+
+
+if __name__ == '__main__':
+    main()
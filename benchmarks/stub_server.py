@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import Callable, Dict, Tuple, Union
+
+# A route returns (status, headers, body). It may be a static tuple or a
+# callable that receives the request handler, e.g. to honor If-None-Match.
+Route = Union[Tuple[int, Dict, bytes],
+              Callable[[BaseHTTPRequestHandler], Tuple[int, Dict, bytes]]]
+
+
+def json_route(content: Dict, status: int=200) -> Tuple[int, Dict, bytes]:
+    return (status,
+            {'Content-Type': "application/json"},
+            json.dumps(content).encode())
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    # The default backlog of 5 drops connections under bursts of clients.
+    request_queue_size = 1024
+
+
+class StubServer(object):
+    def __init__(self, routes: Dict[str, Route]=None, delay: float=0):
+        self.routes = routes if routes else dict()
+        self.delay = delay
+        self.request_count = 0
+        self.connection_count = 0
+        self._lock = threading.Lock()
+        self.__server = _ThreadingHTTPServer(('127.0.0.1', 0),
+                                             self.__create_handler())
+        self.__thread = None
+
+    @property
+    def base_url(self) -> str:
+        return "http://127.0.0.1:%d/" % self.__server.server_address[1]
+
+    def __create_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # HTTP/1.1 so clients can keep the connection alive.
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are written separately; without this Nagle's
+            # algorithm stalls every keep-alive response on a delayed ACK.
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                with stub._lock:
+                    stub.connection_count += 1
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                self.respond()
+
+            def do_POST(self):
+                self.respond()
+
+            def do_PATCH(self):
+                self.respond()
+
+            def respond(self):
+                with stub._lock:
+                    stub.request_count += 1
+
+                # Kept for routes that dispatch on a form body.
+                length = int(self.headers.get('Content-Length', 0))
+                self.body = self.rfile.read(length) if length else b''
+
+                if stub.delay:
+                    threading.Event().wait(stub.delay)
+
+                route = stub.routes.get(self.path.split('?')[0])
+                if route is None:
+                    status, headers, body = json_route({}, 404)
+                elif callable(route):
+                    status, headers, body = route(self)
+                else:
+                    status, headers, body = route
+
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+    def start(self) -> 'StubServer':
+        self.__thread = threading.Thread(target=self.__server.serve_forever)
+        self.__thread.daemon = True
+        self.__thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    def __enter__(self) -> 'StubServer':
+        return self.start()
+
+    def __exit__(self, *_) -> None:
+        self.stop()
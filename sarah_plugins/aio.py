@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+# asyncio counterparts of sarah_plugins.transport and the glue to run
+# coroutine command handlers under the current thread based bot core.
+#
+# Every coroutine runs on one event loop owned by a daemon thread, so the
+# shared aiohttp session, its keep-alive pools and the caches in plugins
+# are used from a single loop no matter which worker thread calls in.
+#
+# aiohttp takes about a quarter of a second to import, so it is imported on
+# the first request rather than when a plugin importing this module loads.
+import asyncio
+import functools
+import json
+import threading
+from typing import Any, Awaitable, Callable, Dict, Tuple, Union
+
+_lock = threading.Lock()
+_loop = None
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    if _loop is None:
+        with _lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=loop.run_forever,
+                                          name="sarah_plugins.aio")
+                thread.daemon = True
+                thread.start()
+                _loop = loop
+    return _loop
+
+
+def run_sync(coroutine: Awaitable) -> Any:
+    # Block the calling thread until the coroutine finishes on the shared
+    # loop. Never call this from a coroutine running on that loop.
+    return asyncio.run_coroutine_threadsafe(coroutine, get_loop()).result()
+
+
+def synchronize(coroutine_function: Callable[..., Awaitable]) -> Callable:
+    # Thin adapter so a coroutine handler can be registered with the sync
+    # Slack.command/HipChat.command/Slack.schedule decorators. The coroutine
+    # itself stays reachable for an asyncio based core as .coroutine.
+    @functools.wraps(coroutine_function)
+    def wrapper(*args, **kwargs):
+        return run_sync(coroutine_function(*args, **kwargs))
+
+    wrapper.coroutine = coroutine_function
+    return wrapper
+
+
+async def to_thread(function: Callable, *args, **kwargs) -> Any:
+    # Run blocking work such as parsing or rendering off the event loop.
+    return await asyncio.get_event_loop().run_in_executor(
+        None, functools.partial(function, *args, **kwargs))
+
+
+class AsyncResponse(object):
+    # The part of requests.Response the plugins rely on.
+    def __init__(self, status_code: int, headers: Dict, content: bytes):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self) -> Any:
+        return json.loads(self.content.decode())
+
+
+class AsyncHttpClient(object):
+    def __init__(self,
+                 connect_timeout: float=3.05,
+                 read_timeout: float=10,
+                 max_retries: int=2,
+                 backoff_factor: float=0.3,
+                 limit_per_host: int=10,
+                 status_forcelist: Tuple[int, ...]=(500, 502, 503, 504),
+                 retry_methods: Tuple[str, ...]=('GET', 'HEAD')):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.limit_per_host = limit_per_host
+        self.status_forcelist = status_forcelist
+        # Like urllib3's Retry, never resend a request that may have taken
+        # effect, e.g. a gist POST that timed out after GitHub created it.
+        self.retry_methods = retry_methods
+        self.__sessions = dict()
+
+    def session(self) -> 'aiohttp.ClientSession':
+        # A session is bound to the loop it was created in, so keep one per
+        # loop in case a caller drives its own loop instead of get_loop().
+        import aiohttp
+        loop = asyncio.get_event_loop()
+        session = self.__sessions.get(loop, None)
+        if session is None or session.closed:
+            session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit_per_host=self.limit_per_host),
+                timeout=aiohttp.ClientTimeout(
+                    sock_connect=self.connect_timeout,
+                    sock_read=self.read_timeout))
+            self.__sessions[loop] = session
+        return session
+
+    async def request(self,
+                      method: str,
+                      url: str,
+                      **kwargs) -> AsyncResponse:
+        import aiohttp
+        max_retries = self.max_retries \
+            if method.upper() in self.retry_methods else 0
+        attempt = 0
+        while True:
+            try:
+                async with self.session().request(method,
+                                                  url,
+                                                  **kwargs) as response:
+                    content = await response.read()
+                    if response.status not in self.status_forcelist \
+                            or attempt >= max_retries:
+                        return AsyncResponse(response.status,
+                                             response.headers,
+                                             content)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt >= max_retries:
+                    raise
+
+            await asyncio.sleep(self.backoff_factor * (2 ** attempt))
+            attempt += 1
+
+    async def get(self,
+                  url: str,
+                  params: Union[Dict, str]=None,
+                  **kwargs) -> AsyncResponse:
+        return await self.request('GET', url, params=params, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> AsyncResponse:
+        return await self.request('POST', url, **kwargs)
+
+    async def patch(self, url: str, **kwargs) -> AsyncResponse:
+        return await self.request('PATCH', url, **kwargs)
+
+    async def close(self) -> None:
+        session = self.__sessions.pop(asyncio.get_event_loop(), None)
+        if session is not None:
+            await session.close()
+
+
+_client = None
+
+
+def get_client() -> AsyncHttpClient:
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = AsyncHttpClient()
+    return _client
+
+
+def configure(**kwargs) -> AsyncHttpClient:
+    # Replace the shared client. Accepts the same keyword arguments as
+    # AsyncHttpClient, like sarah_plugins.transport.configure.
+    global _client
+    with _lock:
+        old_client = _client
+        _client = AsyncHttpClient(**kwargs)
+    if old_client and _loop is not None:
+        asyncio.run_coroutine_threadsafe(old_client.close(), _loop)
+    return _client
+
+
+async def request(method: str, url: str, **kwargs) -> AsyncResponse:
+    return await get_client().request(method, url, **kwargs)
+
+
+async def get(url: str,
+              params: Union[Dict, str]=None,
+              **kwargs) -> AsyncResponse:
+    return await get_client().get(url, params=params, **kwargs)
+
+
+async def post(url: str, **kwargs) -> AsyncResponse:
+    return await get_client().post(url, **kwargs)
+
+
+async def patch(url: str, **kwargs) -> AsyncResponse:
+    return await get_client().patch(url, **kwargs)
@@ -1,109 +1,385 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import copy
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from plotly.graph_objs import Data, Scatter
-from plotly.plotly import plotly
-from plotly.tools import FigureFactory
 
-import requests
 import logging
 import json
-from sarah.bot.slack import Slack, SlackMessage, MessageAttachment
+import re
+from sarah.bot.slack import Slack, SlackMessage, MessageAttachment, \
+    AttachmentField
 from sarah.bot.values import CommandMessage
-from typing import Dict
+from sarah_plugins import aio, breaker, metrics, ratelimit
+from sarah_plugins.aio import synchronize, to_thread
+from sarah_plugins.cache import AsyncRequestCoalescer, TTLCache
+from sarah_plugins.chart import ChartRenderer, create_storage
+from sarah_plugins.ohlcv import OHLCV
+from sarah_plugins.timeseries import TimeSeriesStore, get_store
+from typing import Dict, Sequence, Tuple
+
+
+BARCHART_API_URL = "http://marketdata.websol.barchart.com/"
+
+
+class BarchartApiError(Exception):
+    # The API answered with an error status, e.g. for an unknown symbol.
+    pass
+
+
+# While the API is down, the last good response for the same request is
+# served with its age.
+barchart_breaker = breaker.CircuitBreaker('barchart',
+                                          ignore=(BarchartApiError,))
+
+
+def response_key(method: str, params: Dict) -> Tuple:
+    return method, tuple(sorted(params.items()))
 
 
 class BarchartClient(object):
     def __init__(self,
                  token: str,
-                 base_url: str="http://marketdata.websol.barchart.com/"):
+                 base_url: str=BARCHART_API_URL,
+                 store: TimeSeriesStore=None,
+                 priority: str=ratelimit.COMMAND):
         self.token = token
         self.base_url = base_url
+        self.store = store
+        self.priority = priority
 
     def generate_endpoint(self, method: str) -> str:
         # http://www.barchartondemand.com/api.php
         return "%s%s.json" % (self.base_url, method)
 
-    def get(self, method: str, params: Dict=None):
-        params = params if params else dict()
-        params.update({'key': self.token})
+    async def request(self, method: str, params: Dict):
+        params = dict(params, key=self.token)
         endpoint = self.generate_endpoint(method)
 
         try:
-            response = requests.get(endpoint, params)
-            decoded_content = json.loads(response.content.decode())
+            with metrics.timer('barchart', 'upstream'):
+                response = await aio.get(endpoint, params=params)
+            with metrics.timer('barchart', 'decode'):
+                decoded_content = json.loads(response.content.decode())
             if int(decoded_content['status']['code']) == 200:
                 return decoded_content
             else:
-                raise Exception("Something went wrong %s" % response.content)
+                raise BarchartApiError(
+                    "Something went wrong %s" % response.content)
         except Exception as e:
             logging.error(e)
             raise
 
-    def get_history(self, symbol):
-        start_date = datetime.today() - timedelta(days=30)
-        return self.get("getHistory",
-                        {'symbol': symbol,
-                         'startDate': start_date.strftime("%Y-%m-%dT00:00:00"),
-                         'order': "desc",
-                         'type': "daily"})
+    async def get(self, method: str, params: Dict=None):
+        params = params if params else dict()
+        key = response_key(method, params)
+        # Waited for outside the breaker, so a request cancelled while
+        # queued for a token is not taken for an upstream failure.
+        try:
+            await ratelimit.acquire_async('barchart', self.priority)
+        except ratelimit.RateLimitExceeded as e:
+            return barchart_breaker.fallback(key, e)
+
+        return await barchart_breaker.call_async(key,
+                                                 self.request,
+                                                 method,
+                                                 params)
+
+    def request_since(self, symbol: str, start_date: str) -> str:
+        # Only request what the store does not have yet. The newest stored
+        # day is requested again since it may have been stored intraday.
+        if self.store is None:
+            return start_date
+
+        series = "barchart:%s" % symbol
+        covered_since, _ = self.store.coverage(series)
+        latest_date = self.store.latest_date(series)
+        if covered_since and covered_since <= start_date and latest_date:
+            return latest_date
+        else:
+            return start_date
+
+    def store_history(self,
+                      symbol: str,
+                      response: Dict,
+                      request_since: str,
+                      start_date: str) -> Dict:
+        if self.store is None:
+            return response
+
+        series = "barchart:%s" % symbol
+        self.store.put_many(series,
+                            [(r['tradingDay'], r)
+                             for r in response['results']],
+                            request_since)
+
+        # The breaker keeps the response as its stale fallback, so annotate
+        # a copy. copy keeps a StaleResponse's age.
+        response = copy.copy(response)
+        response['results'] = self.store.get(series,
+                                             start_date,
+                                             descending=True)
+        return response
+
+    async def get_history(self, symbol: str, days: int=30) -> Dict:
+        start_date = (datetime.today() - timedelta(days=days)).strftime(
+            "%Y-%m-%d")
+        # The store is SQLite; keep its reads and writes off the event loop.
+        request_since = await to_thread(self.request_since,
+                                        symbol,
+                                        start_date)
+        return await to_thread(
+            self.store_history,
+            symbol,
+            await self.request_history(symbol, request_since),
+            request_since,
+            start_date)
+
+    @staticmethod
+    def history_params(symbol: str, start_date: str) -> Dict:
+        return {'symbol': symbol,
+                'startDate': "%sT00:00:00" % start_date,
+                'order': "desc",
+                'type': "daily"}
+
+    async def request_history(self, symbol: str, start_date: str) -> Dict:
+        return await self.get("getHistory",
+                              self.history_params(symbol, start_date))
+
+
+STOCK_COMMAND_PATTERN = re.compile(r'''
+    \s*((?:[a-zA-Z0-9.^=\-]+)(?:[\s,]+[a-zA-Z0-9.^=\-]+)*?)  # ticker symbols
+    (?:\s+(\d+)([dwmyDWMY]))?\s*$  # optional window such as 90d or 1y
+    ''', re.VERBOSE)
+
+WINDOW_UNIT_DAYS = {'d': 1, 'w': 7, 'm': 30, 'y': 365}
+
+# Finished histories are kept until the date changes, and identical
+# requests in flight are sent upstream only once.
+history_cache = TTLCache(maxsize=128, ttl=24 * 60 * 60)
+metrics.register_cache('barchart.history', history_cache)
+history_coalescer = AsyncRequestCoalescer()
+
+
+def seconds_until_tomorrow(now: datetime) -> float:
+    tomorrow = datetime(now.year, now.month, now.day) + timedelta(days=1)
+    return (tomorrow - now).total_seconds()
+
+
+async def fetch_history(client: BarchartClient,
+                        symbol: str,
+                        days: int) -> Dict:
+    today = datetime.today()
+    key = (symbol, days, today.strftime("%Y-%m-%d"))
+    response = history_cache.get(key)
+    if response is None:
+        response = await history_coalescer.call(key,
+                                                client.get_history,
+                                                symbol,
+                                                days)
+        # A stale history is not kept, so the next command tries again.
+        if breaker.stale_age(response) is None:
+            history_cache.set(key, response, seconds_until_tomorrow(today))
+
+    return response
+
+
+def indicator_fields(ohlcv: OHLCV) -> Sequence[AttachmentField]:
+    fields = [AttachmentField("Close", "%.2f" % ohlcv.close[-1], True)]
+
+    for window in (5, 20, 50, 200):
+        moving_average = ohlcv.moving_average(window)
+        if len(moving_average):
+            fields.append(AttachmentField("SMA %d" % window,
+                                          "%.2f" % moving_average[-1],
+                                          True))
+
+    vwap = ohlcv.vwap()
+    if vwap is not None:
+        fields.append(AttachmentField("VWAP", "%.2f" % vwap, True))
+
+    returns = ohlcv.daily_returns()
+    if len(returns):
+        fields.append(AttachmentField("Daily Return",
+                                      "%+.2f%%" % (returns[-1] * 100),
+                                      True))
+
+    volatility = ohlcv.volatility()
+    if volatility is not None:
+        fields.append(AttachmentField("Volatility (annualized)",
+                                      "%.2f%%" % (volatility * 100),
+                                      True))
+
+    return fields
+
+
+def price_attachments(ohlcv: OHLCV,
+                      config: Dict) -> Sequence[MessageAttachment]:
+    dates = ohlcv.dates.tolist()
+    open_prices = ohlcv.open.tolist()
+    high_prices = ohlcv.high.tolist()
+    low_prices = ohlcv.low.tolist()
+    close_prices = ohlcv.close.tolist()
+    volumes = ohlcv.volume.tolist()
+
+    storage = create_storage(config)
+    if storage:
+        # Render in-process instead of uploading to plot.ly
+        renderer = ChartRenderer(storage)
+        candle_graph_url = renderer.candlestick(dates,
+                                                open_prices,
+                                                high_prices,
+                                                low_prices,
+                                                close_prices)
+        candle_image_url = candle_graph_url
+        volume_graph_url = renderer.bars(dates, volumes)
+        volume_image_url = volume_graph_url
+    else:
+        # Imported here so that deployments rendering charts locally, or
+        # not using this plugin's commands, don't pay for plotly.
+        from plotly.graph_objs import Data, Scatter
+        from plotly.plotly import plotly
+        from plotly.tools import FigureFactory
+        with metrics.timer('barchart', 'upload'):
+            candle_graph_url = plotly.plot(
+                FigureFactory.create_candlestick(open_prices,
+                                                 high_prices,
+                                                 low_prices,
+                                                 close_prices,
+                                                 dates=dates),
+                filename="barchart/price_" + dates[-1],
+                vadlidate=False)
+        candle_image_url = candle_graph_url + ".png"
+
+        with metrics.timer('barchart', 'upload'):
+            volume_graph_url = plotly.plot(
+                Data([Scatter(x=dates,
+                              y=volumes)]))
+        volume_image_url = volume_graph_url + ".png"
+
+    return [
+        MessageAttachment(fallback="stock price history",
+                          title="stock price history",
+                          title_link=candle_graph_url,
+                          image_url=candle_image_url),
+        MessageAttachment(fallback="volume history",
+                          title="volume history",
+                          title_link=volume_graph_url,
+                          image_url=volume_image_url),
+        MessageAttachment(fallback="indicators",
+                          title="Indicators",
+                          fields=indicator_fields(ohlcv))]
+
+
+def comparison_attachments(histories: Sequence[Tuple[str, OHLCV]],
+                           config: Dict) -> Sequence[MessageAttachment]:
+    # One chart of close prices for all symbols, plus indicators for each.
+    series = [(symbol, ohlcv.dates.tolist(), ohlcv.close.tolist())
+              for symbol, ohlcv in histories]
+
+    storage = create_storage(config)
+    if storage:
+        graph_url = ChartRenderer(storage).lines(series)
+        image_url = graph_url
+    else:
+        from plotly.graph_objs import Data, Scatter
+        from plotly.plotly import plotly
+        with metrics.timer('barchart', 'upload'):
+            graph_url = plotly.plot(
+                Data([Scatter(x=dates, y=closes, name=symbol)
+                      for symbol, dates, closes in series]))
+        image_url = graph_url + ".png"
+
+    attachments = [MessageAttachment(fallback="close price history",
+                                     title="close price history",
+                                     title_link=graph_url,
+                                     image_url=image_url)]
+    for symbol, ohlcv in histories:
+        attachments.append(MessageAttachment(fallback=symbol,
+                                             title=symbol,
+                                             fields=indicator_fields(ohlcv)))
+
+    return attachments
 
 
 @Slack.command(".stock")
-def slack_stock_price(msg: CommandMessage, config: Dict):
-    if len(msg.text) > 1:
+@synchronize
+@metrics.timed('barchart')
+async def slack_stock_price(msg: CommandMessage, config: Dict):
+    match = STOCK_COMMAND_PATTERN.match(msg.text)
+    if not match:
+        return ("Please enter ticker symbol. "
+                "e.g. .stock AAPL, .stock AAPL 1y or .stock AAPL MSFT GOOG")
+
+    symbols, window, unit = match.groups()
+    symbols = list(OrderedDict.fromkeys(
+        re.split(r'[\s,]+', symbols.upper())))[:config.get('max_symbols', 10)]
+    days = int(window) * WINDOW_UNIT_DAYS[unit.lower()] if window else 30
+    days = min(days, config.get('max_days', 5 * 365))
+
+    ratelimit.configure(config.get('rate_limits', {}))
+    store = await to_thread(get_store,
+                            config.get('timeseries_path',
+                                       "sarah_timeseries.sqlite3"))
+    client = BarchartClient(config.get('api_key', ''),
+                            config.get('base_url', BARCHART_API_URL),
+                            store)
+
+    # Bound the number of requests in flight for one command.
+    semaphore = asyncio.Semaphore(config.get('max_workers', 5))
+
+    async def fetch(symbol: str) -> Dict:
+        async with semaphore:
+            return await fetch_history(client, symbol, days)
+
+    responses = await asyncio.gather(*[fetch(symbol) for symbol in symbols],
+                                     return_exceptions=True)
+
+    histories = []
+    failed_symbols = []
+    stale_ages = []
+    for symbol, response in zip(symbols, responses):
         try:
-            response = BarchartClient(config.get('api_key', '')) \
-                .get_history(msg.text.upper())
-        except:
-            # API request error
-            # Already logged in BarchartClient, so just return error message.
-            return "Something went wrong with %s" % msg.text
+            if isinstance(response, Exception):
+                raise response
+            histories.append((symbol,
+                              await to_thread(OHLCV.from_results,
+                                              response['results'])))
+            if breaker.stale_age(response) is not None:
+                stale_ages.append(breaker.stale_age(response))
+        except Exception as e:
+            # API request error is already logged in BarchartClient.
+            logging.error("History of %s is not available. %s",
+                          symbol, e)
+            failed_symbols.append(symbol)
+
+    if not histories:
+        return "Something went wrong with %s" % msg.text
+
+    try:
+        # Rendering and uploading block, so keep them off the event loop.
+        if len(histories) == 1:
+            attachments = await to_thread(price_attachments,
+                                          histories[0][1],
+                                          config)
         else:
-            try:
-                open_prices = []
-                high_prices = []
-                low_prices = []
-                close_prices = []
-                dates = []
-                volumes = []
-                for result in response['results']:
-                    open_prices.append(result['open'])
-                    high_prices.append(result['high'])
-                    low_prices.append(result['low'])
-                    close_prices.append(result['close'])
-                    dates.append(result['tradingDay'])
-                    volumes.append(result['volume'])
-
-                candle_graph_url = plotly.plot(
-                    FigureFactory.create_candlestick(open_prices,
-                                                     high_prices,
-                                                     low_prices,
-                                                     close_prices,
-                                                     dates=dates),
-                    filename="barchart/price_" + dates[-1],
-                    vadlidate=False)
-
-                volume_graph_url = plotly.plot(
-                    Data([Scatter(x=dates,
-                                  y=volumes)]))
-
-                attachments = [
-                    MessageAttachment(fallback="stock price history",
-                                      title="stock price history",
-                                      title_link=candle_graph_url,
-                                      image_url=candle_graph_url + ".png"),
-                    MessageAttachment(fallback="volume history",
-                                      title="volume history",
-                                      title_link=volume_graph_url,
-                                      image_url=volume_graph_url + ".png")]
-
-                return SlackMessage(
-                    text="Stock price history for %s" % msg.text,
-                    attachments=attachments)
-            except Exception as e:
-                # Response handling error
-                logging.error(e)
-                return "Something went wrong with %s" % msg.text
+            attachments = await to_thread(comparison_attachments,
+                                          histories,
+                                          config)
+    except Exception as e:
+        # Response handling error
+        logging.error(e)
+        return "Something went wrong with %s" % msg.text
 
-    else:
-        return "Please enter ticker symbol."
+    if failed_symbols:
+        message = "Something went wrong with %s" % ", ".join(failed_symbols)
+        attachments.append(MessageAttachment(fallback=message,
+                                             title=message,
+                                             color="#FF0000"))
+
+    text = "Stock price history for %s (%d days)" % (
+        ", ".join(symbol for symbol, _ in histories), days)
+    if stale_ages:
+        text += " " + breaker.age_marker(max(stale_ages))
+
+    return SlackMessage(text=text, attachments=attachments)
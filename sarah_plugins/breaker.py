@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+# Circuit breakers for upstream APIs, so a dead upstream costs one failed
+# request per reset_timeout instead of a full connection attempt per
+# command.
+#
+#   response = await barchart_breaker.call_async(key, self.request, ...)
+#
+# After failure_threshold consecutive failures the circuit opens and calls
+# fail fast. Once reset_timeout has passed, one call at a time is let
+# through as a probe; its success closes the circuit and its failure opens
+# it again. Exceptions listed in `ignore` mean the upstream did answer, e.g.
+# with "unknown location", and count as a success. A call cancelled or
+# interrupted by its caller says nothing about the upstream and counts as
+# neither.
+#
+# The last good response for each key is kept for max_stale seconds. A
+# call that fails, or is refused while the circuit is open, returns that
+# response as a StaleResponse carrying its age instead of raising.
+import asyncio
+import logging
+import threading
+import time
+from sarah_plugins import metrics
+from sarah_plugins.cache import TTLCache
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class StaleResponse(dict):
+    # Copy of the last good response. age is in seconds.
+    def __init__(self, response: Dict, age: float):
+        super().__init__(response)
+        self.age = age
+
+
+def stale_age(response: Any) -> Optional[float]:
+    return response.age if isinstance(response, StaleResponse) else None
+
+
+def age_marker(age: float) -> str:
+    if age < 60:
+        return "(as of %d seconds ago)" % age
+    elif age < 60 * 60:
+        return "(as of %d minutes ago)" % (age // 60)
+    else:
+        return "(as of %d hours ago)" % (age // (60 * 60))
+
+
+class CircuitBreaker(object):
+    def __init__(self,
+                 name: str,
+                 failure_threshold: int=5,
+                 reset_timeout: float=30,
+                 max_stale: float=24 * 60 * 60,
+                 maxsize: int=256,
+                 ignore: Tuple[type, ...]=()):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.ignore = ignore
+        self.__lock = threading.Lock()
+        self.__state = CLOSED
+        self.__failures = 0
+        self.__opened_at = 0
+        self.__last_good = TTLCache(maxsize, max_stale, time.time)
+        metrics.register_cache("breaker.%s.last_good" % name,
+                               self.__last_good)
+        metrics.register_gauge("breaker.%s.open" % name,
+                               lambda: 0 if self.state == CLOSED else 1)
+
+    @property
+    def state(self) -> str:
+        return self.__state
+
+    def allow(self) -> bool:
+        with self.__lock:
+            if self.__state == CLOSED:
+                return True
+            elif self.__state == OPEN and \
+                    time.monotonic() - self.__opened_at >= self.reset_timeout:
+                # This caller is the probe; others keep failing fast.
+                self.__state = HALF_OPEN
+                return True
+            return False
+
+    def succeeded(self, key: Hashable, response: Any=None) -> None:
+        with self.__lock:
+            if self.__state != CLOSED:
+                logging.info("Circuit %s closed.", self.name)
+            self.__state = CLOSED
+            self.__failures = 0
+        if response is not None:
+            self.__last_good.set(key, (time.time(), response))
+
+    def released(self) -> None:
+        # No verdict. A probe gives its turn to the next caller.
+        with self.__lock:
+            if self.__state == HALF_OPEN:
+                self.__state = OPEN
+
+    def failed(self) -> None:
+        with self.__lock:
+            self.__failures += 1
+            if self.__state == HALF_OPEN or \
+                    self.__failures >= self.failure_threshold:
+                if self.__state != OPEN:
+                    logging.error("Circuit %s opened after %d failure(s).",
+                                  self.name, self.__failures)
+                self.__state = OPEN
+                self.__opened_at = time.monotonic()
+
+    def stale(self, key: Hashable) -> Optional[StaleResponse]:
+        entry = self.__last_good.get(key)
+        if entry is None:
+            return None
+
+        stored_at, response = entry
+        return StaleResponse(response, time.time() - stored_at)
+
+    def fallback(self, key: Hashable, error: Exception) -> StaleResponse:
+        response = self.stale(key)
+        if response is None:
+            raise error
+
+        logging.warning("Serving %s response from %d seconds ago. %s",
+                        self.name, response.age, error)
+        return response
+
+    def refuse(self, key: Hashable) -> StaleResponse:
+        metrics.count_error(self.name, 'upstream', CircuitOpenError)
+        return self.fallback(key, CircuitOpenError(
+            "Circuit %s is open" % self.name))
+
+    def call(self,
+             key: Hashable,
+             function: Callable[..., Dict],
+             *args,
+             **kwargs) -> Dict:
+        if not self.allow():
+            return self.refuse(key)
+
+        try:
+            response = function(*args, **kwargs)
+        except self.ignore:
+            self.succeeded(key)
+            raise
+        except Exception as e:
+            self.failed()
+            return self.fallback(key, e)
+        except BaseException:
+            # e.g. KeyboardInterrupt; not the upstream's fault.
+            self.released()
+            raise
+
+        self.succeeded(key, response)
+        return response
+
+    async def call_async(self,
+                         key: Hashable,
+                         coroutine_function: Callable[..., Awaitable[Dict]],
+                         *args,
+                         **kwargs) -> Dict:
+        if not self.allow():
+            return self.refuse(key)
+
+        try:
+            response = await coroutine_function(*args, **kwargs)
+        except asyncio.CancelledError:
+            # The caller gave up, e.g. at a schedule's deadline. Caught first
+            # since it is an Exception before Python 3.8.
+            self.released()
+            raise
+        except self.ignore:
+            self.succeeded(key)
+            raise
+        except Exception as e:
+            self.failed()
+            return self.fallback(key, e)
+        except BaseException:
+            self.released()
+            raise
+
+        self.succeeded(key, response)
+        return response
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable
+
+
+def normalize_query(query: str) -> str:
+    # "Tokyo", " tokyo " and "TOKYO" should share one cache entry.
+    return " ".join(query.split()).casefold()
+
+
+class TTLCache(object):
+    def __init__(self,
+                 maxsize: int=256,
+                 ttl: float=600,
+                 clock: Callable[[], float]=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.__lock = threading.Lock()
+        self.__entries = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def get(self, key: Hashable, default: Any=None) -> Any:
+        with self.__lock:
+            entry = self.__entries.get(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            value, expires_at = entry
+            if expires_at <= self.clock():
+                del self.__entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: float=None) -> None:
+        ttl = self.ttl if ttl is None else ttl
+        with self.__lock:
+            self.__entries[key] = (value, self.clock() + ttl)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.maxsize:
+                self.__entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key: Hashable) -> None:
+        with self.__lock:
+            self.__entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__entries.clear()
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        with self.__lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'expirations': self.expirations,
+                    'size': len(self.__entries)}
+
+
+class AsyncRequestCoalescer(object):
+    # Concurrent calls with the same key share one execution of the first
+    # caller's coroutine; the rest wait for and receive its result or error.
+    # Every caller must run on the same event loop.
+    def __init__(self):
+        self.__in_flight = dict()
+
+    async def call(self,
+                   key: Hashable,
+                   coroutine_function: Callable,
+                   *args,
+                   **kwargs) -> Any:
+        future = self.__in_flight.get(key, None)
+        if future is None:
+            future = asyncio.ensure_future(coroutine_function(*args, **kwargs))
+            self.__in_flight[key] = future
+            future.add_done_callback(
+                lambda _: self.__in_flight.pop(key, None))
+
+        # Shielded so that one caller being cancelled does not cancel the
+        # call the others are waiting for.
+        return await asyncio.shield(future)
+
+    @property
+    def in_flight(self) -> int:
+        return len(self.__in_flight)
@@ -1,30 +1,73 @@
 # -*- coding: utf-8 -*-
 
-import requests
 import logging
 import json
 from sarah.bot.hipchat import HipChat
 from sarah.bot.values import CommandMessage
+from sarah_plugins import aio, metrics
+from sarah_plugins.aio import synchronize
+from sarah_plugins.cache import AsyncRequestCoalescer, TTLCache
 from typing import Dict
 
+# Each capture is slow on the device, so a bursty channel shares one
+# in-flight capture and then its URL for a short while.
+snapshot_cache = TTLCache(maxsize=16, ttl=60)
+metrics.register_cache('capture_image.snapshot', snapshot_cache)
+capture_coalescer = AsyncRequestCoalescer()
+
+
+async def capture(endpoint: str, max_age: float=None) -> str:
+    with metrics.timer('capture_image', 'upstream'):
+        response = await aio.get(endpoint)
+
+    # Avoid "can't use a string pattern on a bytes-like object"
+    # j = json.loads(response.content)
+    with metrics.timer('capture_image', 'decode'):
+        decoded_content = json.loads(response.content.decode())
+        url = decoded_content['url']
+    snapshot_cache.set(endpoint, url, max_age)
+
+    return url
+
 
 @HipChat.command('.capture_image')
-def capture_image(_: CommandMessage, config: Dict) -> str:
+@synchronize
+@metrics.timed('capture_image')
+async def capture_image(_: CommandMessage, config: Dict) -> str:
+    endpoint = config.get('endpoint', '')
+    url = snapshot_cache.get(endpoint)
+    if url is not None:
+        return url
+
+    # Already loaded by sarah_plugins.aio once a request is made.
+    import aiohttp
     try:
-        response = requests.request('GET', config.get('endpoint', ''))
-    except requests.HTTPError as e:
+        return await capture_coalescer.call(endpoint,
+                                            capture,
+                                            endpoint,
+                                            config.get('max_age', 60))
+    except aiohttp.ClientError as e:
         logging.error(e)
         return 'Request error.'
+    except (ValueError, LookupError) as e:
+        logging.error(e)
+        return 'Error on parsing response.'
     except Exception as e:
         logging.error(e)
         return 'Unknown error occurred.'
 
+
+# Opt-in pre-capture. Enable this schedule with an interval a bit shorter
+# than max_age so .capture_image is answered at once.
+@HipChat.schedule('capture_image_prefetch')
+@synchronize
+@metrics.timed('capture_image', 'schedule')
+async def prefetch_image(config: Dict) -> None:
+    endpoint = config.get('endpoint', '')
     try:
-        # Avoid "can't use a string pattern on a bytes-like object"
-        # j = json.loads(response.content)
-        decoded_content = json.loads(response.content.decode())
+        await capture_coalescer.call(endpoint,
+                                     capture,
+                                     endpoint,
+                                     config.get('max_age', 60))
     except Exception as e:
-        logging.error(e)
-        return 'Error on parsing response.'
-
-    return decoded_content['url']
+        logging.error("Failed to capture %s. %s", endpoint, e)
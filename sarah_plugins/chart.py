@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+import abc
+import hashlib
+import io
+import json
+import os
+import tempfile
+from sarah_plugins import metrics, transport
+from sarah_plugins.cache import TTLCache
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+
+class ChartStorage(abc.ABC):
+    @abc.abstractmethod
+    def save(self, name: str, content: bytes) -> str:
+        # Store PNG content and return the URL to be shown in a message.
+        pass
+
+    @property
+    @abc.abstractmethod
+    def identity(self) -> Tuple:
+        # Settings that decide where content is saved, so storages with
+        # different settings don't share rendered URLs.
+        pass
+
+
+class LocalStorage(ChartStorage):
+    # Save into a directory served as static files, e.g. by nginx.
+    def __init__(self, directory: str, base_url: str):
+        self.directory = directory
+        self.base_url = base_url if base_url.endswith("/") else base_url + "/"
+
+    @property
+    def identity(self) -> Tuple:
+        return (type(self).__name__, self.directory, self.base_url)
+
+    def save(self, name: str, content: bytes) -> str:
+        path = os.path.join(self.directory, name)
+        if not os.path.exists(path):
+            os.makedirs(self.directory, exist_ok=True)
+            # Write and rename so a half-written file is never served.
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            # mkstemp creates 0600; the web server must be able to read it.
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+
+        return self.base_url + name
+
+
+class SlackFileStorage(ChartStorage):
+    def __init__(self,
+                 token: str,
+                 base_url: str="https://slack.com/api/"):
+        self.token = token
+        self.base_url = base_url
+
+    @property
+    def identity(self) -> Tuple:
+        # Files are uploaded to the token's workspace.
+        return (type(self).__name__, self.base_url,
+                hashlib.sha1(self.token.encode()).hexdigest())
+
+    def call(self, method: str, **kwargs) -> Dict:
+        response = transport.post("%s%s" % (self.base_url, method), **kwargs)
+        decoded_content = response.json()
+        if not decoded_content.get('ok', False):
+            raise Exception("Slack API error on %s: %s" % (
+                method, decoded_content.get('error', response.content)))
+        return decoded_content
+
+    def save(self, name: str, content: bytes) -> str:
+        uploaded = self.call("files.upload",
+                             data={'token': self.token, 'filename': name},
+                             files={'file': (name, content, "image/png")})
+        shared = self.call("files.sharedPublicURL",
+                           data={'token': self.token,
+                                 'file': uploaded['file']['id']})
+
+        # Public permalink is an HTML page; the image itself is served at
+        # url_private with the secret at the end of the permalink.
+        shared_file = shared['file']
+        secret = shared_file['permalink_public'].rsplit("-", 1)[-1]
+        return "%s?pub_secret=%s" % (shared_file['url_private'], secret)
+
+
+def create_storage(config: Dict) -> Optional[ChartStorage]:
+    storage = config.get('chart_storage', None)
+    if storage == "local":
+        return LocalStorage(config['chart_dir'], config['chart_base_url'])
+    elif storage == "slack":
+        return SlackFileStorage(config['slack_token'])
+    else:
+        return None
+
+
+def _new_figure(width: float=8, height: float=4):
+    # Imported here so that plugins not rendering charts don't pay for it.
+    from matplotlib.figure import Figure
+    figure = Figure(figsize=(width, height), dpi=100)
+    return figure, figure.add_subplot(1, 1, 1)
+
+
+def _to_png(figure) -> bytes:
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    buffer = io.BytesIO()
+    figure.tight_layout()
+    FigureCanvasAgg(figure).print_png(buffer)
+    return buffer.getvalue()
+
+
+def _set_date_ticks(axes, dates: Sequence[str], max_ticks: int=8) -> None:
+    step = max(1, len(dates) // max_ticks)
+    positions = list(range(0, len(dates), step))
+    axes.set_xticks(positions)
+    axes.set_xticklabels([dates[i][:10] for i in positions],
+                         rotation=30,
+                         ha="right",
+                         fontsize=8)
+
+
+def draw_candlestick(dates: Sequence[str],
+                     open_prices: Sequence[float],
+                     high_prices: Sequence[float],
+                     low_prices: Sequence[float],
+                     close_prices: Sequence[float]) -> bytes:
+    rows = sorted(zip(dates, open_prices, high_prices, low_prices,
+                      close_prices))
+    figure, axes = _new_figure()
+    positions = range(len(rows))
+    colors = ["#2CA02C" if close >= open_ else "#D62728"
+              for _, open_, _, _, close in rows]
+
+    axes.vlines(positions,
+                [low for _, _, _, low, _ in rows],
+                [high for _, _, high, _, _ in rows],
+                colors=colors,
+                linewidth=1)
+    axes.bar(positions,
+             [max(abs(close - open_), 1e-9) for _, open_, _, _, close in rows],
+             bottom=[min(open_, close) for _, open_, _, _, close in rows],
+             color=colors,
+             width=0.6)
+    _set_date_ticks(axes, [row[0] for row in rows])
+    axes.grid(True, alpha=0.3)
+
+    return _to_png(figure)
+
+
+def draw_bars(dates: Sequence[str], values: Sequence[float]) -> bytes:
+    rows = sorted(zip(dates, values))
+    figure, axes = _new_figure(height=3)
+    axes.bar(range(len(rows)), [value for _, value in rows], color="#1F77B4")
+    _set_date_ticks(axes, [row[0] for row in rows])
+    axes.grid(True, axis="y", alpha=0.3)
+
+    return _to_png(figure)
+
+
+def draw_lines(series: Sequence[Tuple[str,
+                                      Sequence[str],
+                                      Sequence[float]]]) -> bytes:
+    # Each series is (name, dates, values).
+    dates = sorted({d for _, ds, _ in series for d in ds})
+    positions = {d: i for i, d in enumerate(dates)}
+    figure, axes = _new_figure()
+    for name, ds, values in series:
+        rows = sorted(zip(ds, values))
+        axes.plot([positions[d] for d, _ in rows],
+                  [value for _, value in rows],
+                  marker="o",
+                  label=name)
+    _set_date_ticks(axes, dates)
+    axes.grid(True, alpha=0.3)
+    if len(series) > 1:
+        axes.legend(fontsize=8)
+
+    return _to_png(figure)
+
+
+# Identical inputs are rendered and stored only once.
+rendered_cache = TTLCache(maxsize=256, ttl=24 * 60 * 60)
+metrics.register_cache('chart.rendered', rendered_cache)
+
+
+class ChartRenderer(object):
+    def __init__(self, storage: ChartStorage):
+        self.storage = storage
+
+    def publish(self, kind: str, draw: Callable[..., bytes], *inputs) -> str:
+        digest = hashlib.sha1(
+            json.dumps([kind, inputs], sort_keys=True).encode()).hexdigest()
+        cache_key = (self.storage.identity, digest)
+        url = rendered_cache.get(cache_key)
+        if url is None:
+            with metrics.timer('chart', 'render'):
+                content = draw(*inputs)
+            with metrics.timer('chart', 'upload'):
+                url = self.storage.save("%s_%s.png" % (kind, digest), content)
+            rendered_cache.set(cache_key, url)
+
+        return url
+
+    def candlestick(self,
+                    dates: Sequence[str],
+                    open_prices: Sequence[float],
+                    high_prices: Sequence[float],
+                    low_prices: Sequence[float],
+                    close_prices: Sequence[float]) -> str:
+        return self.publish("candlestick",
+                            draw_candlestick,
+                            list(dates),
+                            list(open_prices),
+                            list(high_prices),
+                            list(low_prices),
+                            list(close_prices))
+
+    def bars(self, dates: Sequence[str], values: Sequence[float]) -> str:
+        return self.publish("bars", draw_bars, list(dates), list(values))
+
+    def lines(self,
+              series: Sequence[Tuple[str,
+                                     Sequence[str],
+                                     Sequence[float]]]) -> str:
+        return self.publish("lines",
+                            draw_lines,
+                            [[name, list(ds), list(values)]
+                             for name, ds, values in series])
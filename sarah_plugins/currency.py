@@ -1,161 +1,466 @@
 # -*- coding: utf-8 -*-
+import asyncio
 import json
 import logging
-import requests
 import re
+import time
+from datetime import date, timedelta
+from decimal import Decimal, ROUND_HALF_UP
 from sarah.bot.slack import Slack, MessageAttachment, SlackMessage, \
     AttachmentField
 from sarah.bot.values import CommandMessage, UserContext, InputOption
-from typing import Dict, Sequence, Union
-from plotly.graph_objs import Data, Scatter
-from plotly.plotly import plotly
+from sarah_plugins import aio, breaker, metrics, ratelimit
+from sarah_plugins.aio import synchronize, to_thread
+from sarah_plugins.cache import AsyncRequestCoalescer
+from sarah_plugins.chart import ChartRenderer, create_storage
+from sarah_plugins.timeseries import TimeSeriesStore, get_store
+from typing import Dict, Optional, Sequence, Tuple, Union
+
+# While an API is down, its last good responses are served with their age.
+fixer_breaker = breaker.CircuitBreaker('fixer')
+exchangeratelab_breaker = breaker.CircuitBreaker('exchangeratelab')
+
+
+def response_key(path: str, params: Dict) -> Tuple:
+    return path, tuple(sorted(params.items()))
+
+
+def round_rate(value: Decimal, digits: int=6) -> Decimal:
+    # Cross rates span many orders of magnitude, e.g. JPY per BTC and BTC per
+    # JPY. Fixed decimal places would round small ones to 0, so decimals are
+    # kept up to `digits` significant digits, but integer digits never go.
+    if not value:
+        return value
+    exponent = min(0, value.adjusted() - digits + 1)
+    return value.quantize(Decimal(1).scaleb(exponent),
+                          rounding=ROUND_HALF_UP)
+
+
+class RatesTable(object):
+    def __init__(self,
+                 base: str,
+                 rates: Dict[str, Decimal],
+                 fetched_at: float):
+        self.base = base
+        self.rates = dict(rates)
+        self.rates[base] = Decimal(1)
+        self.fetched_at = fetched_at
+
+    def rate(self, from_currency: str, to_currency: str) -> Decimal:
+        # Units of to_currency per one from_currency, crossed through base.
+        return self.rates[to_currency] / self.rates[from_currency]
+
+    def convert(self,
+                amount: Decimal,
+                from_currency: str,
+                to_currency: str) -> Decimal:
+        return amount * self.rate(from_currency, to_currency)
+
+    def conversion(self,
+                   amount: Union[str, int, Decimal],
+                   from_currency: str,
+                   to_currency: str) -> Dict:
+        from_currency = from_currency.upper()
+        to_currency = to_currency.upper()
+
+        converted_amount = self.convert(
+            Decimal(amount),
+            from_currency,
+            to_currency).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+        rate = round_rate(self.rate(to_currency, from_currency))
+
+        return {'converted_amount': str(converted_amount),
+                'rate': format(rate.normalize(), 'f')}
 
 
 class FixerClient(object):
     def __init__(self,
-                 base_url: str="http://api.fixer.io/"):
+                 base_url: str="http://api.fixer.io/",
+                 base: str="EUR"):
         self.base_url = base_url
+        self.base = base
+        self.__rates_table = None
+        self.__coalescer = AsyncRequestCoalescer()
 
     def generate_endpoint(self, path: str) -> str:
         return "%s%s" % (self.base_url, path)
 
-    def get(self, path: str, params: Dict=None) -> Dict:
-        params = params if params else dict()
+    async def request(self, path: str, params: Dict) -> Dict:
         endpoint = self.generate_endpoint(path)
 
         try:
-            response = requests.get(endpoint, params)
-            decoded_content = json.loads(response.content.decode())
+            with metrics.timer('currency', 'upstream'):
+                response = await aio.get(endpoint, params=params)
+            with metrics.timer('currency', 'decode'):
+                decoded_content = json.loads(response.content.decode())
             return decoded_content
         except Exception as e:
             logging.error(e)
             raise
 
-    def get_current_rate(self,
-                         base: str="USD",
-                         symbols: Sequence[str]=None) -> Dict:
+    async def get(self, path: str, params: Dict=None) -> Dict:
+        params = params if params else dict()
+        return await fixer_breaker.call_async(response_key(path, params),
+                                              self.request,
+                                              path,
+                                              params)
+
+    async def get_current_rate(self,
+                               base: str="USD",
+                               symbols: Sequence[str]=None) -> Dict:
 
         params = {'base': base}
         if symbols:
             params.update({'symbols': ",".join(symbols)})
 
-        return self.get("latest", params)
+        return await self.get("latest", params)
 
-    def convert(self,
-                amount: int,
-                from_currency: str,
-                to_currency: str) -> Dict:
+    def cached_rates_table(self, ttl: float=3600) -> Optional[RatesTable]:
+        rates_table = self.__rates_table
+        if rates_table and time.time() - rates_table.fetched_at < ttl:
+            metrics.count_cache('currency.rates_table', hits=1)
+            return rates_table
+        metrics.count_cache('currency.rates_table', misses=1)
+        return None
+
+    def update_rates_table(self, data: Dict) -> RatesTable:
+        # A stale response keeps its age, so it is replaced on next use.
+        rates_table = RatesTable(data['base'],
+                                 {currency: Decimal(str(rate))
+                                  for currency, rate in data['rates'].items()},
+                                 time.time() - (breaker.stale_age(data) or 0))
+        self.__rates_table = rates_table
+        return rates_table
+
+    async def get_rates_table(self, ttl: float=3600) -> RatesTable:
+        # One "latest" response carries every rate against the base, so all
+        # conversions within the TTL are answered locally.
+        rates_table = self.cached_rates_table(ttl)
+        if rates_table:
+            return rates_table
 
-        rate = self.get_current_rate(
-            to_currency,
-            [from_currency])['rates'][from_currency]
+        data = await self.__coalescer.call("latest",
+                                           self.get_current_rate,
+                                           self.base)
+        return self.update_rates_table(data)
 
-        return {'converted_amount': "%.2f" % (float(amount) / rate),
-                'rate': rate}
+    async def convert(self,
+                      amount: Union[str, int, Decimal],
+                      from_currency: str,
+                      to_currency: str,
+                      ttl: float=3600) -> Dict:
+        rates_table = await self.get_rates_table(ttl)
+        return rates_table.conversion(amount, from_currency, to_currency)
+
+
+fixer_client = FixerClient()
 
 
 class ExchangeRateLabClient(object):
     def __init__(self,
                  token: str,
-                 base_url: str="http://api.exchangeratelab.com/api/"):
+                 base_url: str="http://api.exchangeratelab.com/api/",
+                 store: TimeSeriesStore=None,
+                 max_age: float=3600,
+                 priority: str=ratelimit.COMMAND):
         self.token = token
         self.base_url = base_url
+        self.store = store
+        self.max_age = max_age
+        self.priority = priority
 
     def generate_endpoint(self, target: str) -> str:
         # http://www.exchangeratelab.com/docs
         return "%s%s" % (self.base_url, target)
 
-    def get(self, target: str, params: Dict=None) -> Dict:
-        params = params if params else dict()
-        params.update({'apikey': self.token})
+    async def request(self, target: str, params: Dict) -> Dict:
+        params = dict(params, apikey=self.token)
         endpoint = self.generate_endpoint(target)
 
         try:
-            response = requests.get(endpoint, params)
-            decoded_content = json.loads(response.content.decode())
+            with metrics.timer('currency', 'upstream'):
+                response = await aio.get(endpoint, params=params)
+            with metrics.timer('currency', 'decode'):
+                decoded_content = json.loads(response.content.decode())
             return decoded_content
         except Exception as e:
             logging.error(e)
             raise
 
-    def get_current_top8(self, base_currency: str) -> Dict:
+    async def get(self, target: str, params: Dict=None) -> Dict:
+        params = params if params else dict()
+        key = response_key(target, params)
+        # Waited for outside the breaker, so a request cancelled while
+        # queued for a token is not taken for an upstream failure.
+        try:
+            await ratelimit.acquire_async('exchangeratelab', self.priority)
+        except ratelimit.RateLimitExceeded as e:
+            return exchangeratelab_breaker.fallback(key, e)
+
+        return await exchangeratelab_breaker.call_async(key,
+                                                        self.request,
+                                                        target,
+                                                        params)
+
+    async def get_current_top8(self, base_currency: str) -> Dict:
         # https://gist.github.com/anonymous/223204059a31e80a2dab
-        return self.get("current/%s" % base_currency)
+        return await self.get("current/%s" % base_currency)
+
+    def stored_weekly(self, currency: str) -> Optional[Dict]:
+        # The API has no date range parameter, so the best that can be done
+        # is to skip the request while the stored points are up to date.
+        if self.store is None:
+            return None
+
+        series = "exchangeratelab:%s" % currency
+        _, fetched_at = self.store.coverage(series)
+        latest_date = self.store.latest_date(series)
+        if not latest_date or fetched_at is None or (
+                latest_date[:10] < date.today().isoformat() and
+                time.time() - fetched_at >= self.max_age):
+            return None
+
+        start_date = (date.today() - timedelta(days=7)).isoformat()
+        return {'currencies': self.store.get(series, start_date)}
+
+    def store_weekly(self, currency: str, data: Dict) -> Dict:
+        if self.store is None:
+            return data
+
+        series = "exchangeratelab:%s" % currency
+        start_date = (date.today() - timedelta(days=7)).isoformat()
+        self.store.put_many(series,
+                            [(d['dateCurrencyRate'], d)
+                             for d in data['currencies']],
+                            start_date)
 
-    def get_weekly(self, currency: str) -> Dict:
+        data = dict(data)
+        data['currencies'] = self.store.get(series, start_date)
+        return data
+
+    async def get_weekly(self, currency: str) -> Dict:
         # https://gist.github.com/anonymous/e2d493d8d12948437ff0
-        return self.get("history/week", {'curr': currency})
+        # The store is SQLite; keep its reads and writes off the event loop.
+        data = await to_thread(self.stored_weekly, currency)
+        if data is None:
+            data = await to_thread(
+                self.store_weekly,
+                currency,
+                await self.get("history/week", {'curr': currency}))
+        return data
+
+
+CONVERSION_PATTERN = re.compile(r'''
+    \s*(\d+(?:\.\d+)?)                    # Decimal number
+    \s*([a-zA-Z]{3})                     # 3-letter currency code
+    \s+(?:in|as|of|to)\s+                # preposition
+    ([a-zA-Z]{3}(?:\s*,\s*[a-zA-Z]{3})*)  # comma separated currency codes
+    ''', re.VERBOSE)
 
 
 @Slack.command('.currency')
-def slack_currency(msg: CommandMessage,
-                   config: Dict) -> Union[str, UserContext]:
-    regex = re.compile(r'''
-        (\d+(?:\.\d+)?)        # Decimal number
-        \s*([a-zA-Z]{3})       # 3-letter currency code
-        \s+(?:in|as|of|to)\s+  # preposition
-        ([a-zA-Z]{3})          # 3-letter currency code
-        ''', re.VERBOSE)
-    match = regex.match(msg.text)
-
-    if not match:
+@synchronize
+@metrics.timed('currency')
+async def slack_currency(
+        msg: CommandMessage,
+        config: Dict) -> Union[str, UserContext, SlackMessage]:
+    # One conversion per line, each with one or more target currencies.
+    conversions = []
+    for line in filter(None, [t.strip() for t in msg.text.splitlines()]):
+        match = CONVERSION_PATTERN.match(line)
+        if not match:
+            conversions = []
+            break
+
+        amount, of, targets = match.groups()
+        conversions.append((amount,
+                            of.upper(),
+                            [to.strip().upper() for to in targets.split(",")]))
+
+    if not conversions:
         help_message = (
             "Please input command in a form below:\n"
             ".currency {AMOUNT_NUMBER} {BASE_CURRENCY} to {TARGET_CURRENCY}\n"
-            "e.g. .currency 100 JPY to USD")
+            "e.g. .currency 100 JPY to USD\n"
+            "Multiple targets and lines are allowed:\n"
+            ".currency 100 USD to JPY,EUR,GBP")
         return UserContext(message=help_message,
                            help_message=help_message,
                            input_options=(InputOption(".", slack_currency), ))
 
-    amount, of, to = match.groups()
     try:
-        data = FixerClient().convert(amount, of, to)
+        # Every target is resolved from the very same rates table.
+        rates_table = await fixer_client.get_rates_table(
+            config.get('rates_ttl', 3600))
     except:
         return "Something went wrong. Input: %s" % msg.text
-    else:
-        return "%s (1%s = %s%s)" % (data['converted_amount'],
-                                    to,
-                                    data['rate'],
-                                    of)
+
+    # Older than the TTL only when fixer.io failed and its last good
+    # response was served.
+    age = time.time() - rates_table.fetched_at
+    age_marker = breaker.age_marker(age) \
+        if age >= config.get('rates_ttl', 3600) else None
+
+    if len(conversions) == 1 and len(conversions[0][2]) == 1:
+        amount, of, (to, ) = conversions[0]
+        try:
+            data = rates_table.conversion(amount, of, to)
+        except:
+            return "Something went wrong. Input: %s" % msg.text
+        else:
+            return " ".join(filter(None, [
+                "%s (1%s = %s%s)" % (data['converted_amount'],
+                                     to,
+                                     data['rate'],
+                                     of),
+                age_marker]))
+
+    attachments = []
+    for amount, of, targets in conversions:
+        fields = []
+        for to in targets:
+            try:
+                data = rates_table.conversion(amount, of, to)
+            except LookupError:
+                value = "Unknown currency"
+            else:
+                value = "%s (1%s = %s%s)" % (data['converted_amount'],
+                                             to,
+                                             data['rate'],
+                                             of)
+            fields.append(AttachmentField(to, value, True))
+
+        title = "%s %s" % (amount, of)
+        attachments.append(MessageAttachment(fallback=title,
+                                             title=title,
+                                             fields=fields))
+
+    return SlackMessage(text=" ".join(filter(None, ["Currency conversion",
+                                                    age_marker])),
+                        attachments=attachments)
+
+
+def plot_histories(
+        histories: Sequence[Tuple[str, Sequence[str], Sequence[float]]]
+) -> str:
+    # Imported on first use, off the event loop; plotly is slow to import.
+    from plotly.graph_objs import Data, Scatter
+    from plotly.plotly import plotly
+    return plotly.plot(Data([Scatter(x=dates, y=rates, name=currency,
+                                     mode='lines+markers')
+                             for currency, dates, rates in histories]))
 
 
 @Slack.schedule('summary_report')
-def summary_report(config: Dict) -> Union[str, SlackMessage]:
+@synchronize
+@metrics.timed('currency', 'schedule')
+async def summary_report(config: Dict) -> Union[str, SlackMessage]:
+    ratelimit.configure(config.get('rate_limits', {}))
     try:
-        client = ExchangeRateLabClient(config['exchange_rate_lab_api_key'])
-
-        # Currency rates for past one week
-        scatters = []
-        # for currency in ['AUD', 'CAD', 'CNY', 'EUR', 'GBP', 'INR', 'JPY']:
-        for currency in ['JPY']:
-            data = client.get_weekly(currency)
-            scatters.append(Scatter(
-                x=[daily['dateCurrencyRate'] for daily in data['currencies']],
-                y=[daily['amountTo'] for daily in data['currencies']],
-                name=currency,
-                mode='lines+markers'
-            ))
-        weekly_plot_url = plotly.plot(Data(scatters))
-        attachments = [
-            MessageAttachment(fallback="Currency rate history",
-                              pretext="Currency rate history",
-                              title="Base currency: USD",
-                              title_link=weekly_plot_url,
-                              image_url=weekly_plot_url + ".png")]
-
-        # Add current rates
-        current_top8 = client.get_current_top8("JPY")
+        # Leaves the reserved part of the quota to commands.
+        client = ExchangeRateLabClient(
+            config['exchange_rate_lab_api_key'],
+            store=await to_thread(get_store,
+                                  config.get('timeseries_path',
+                                             "sarah_timeseries.sqlite3")),
+            priority=ratelimit.SCHEDULE)
+    except KeyError as e:
+        logging.error("Missing configuration. %s", e)
+        return "Something went wrong"
+
+    currencies = config.get('currencies',
+                            ['AUD', 'CAD', 'CNY', 'EUR', 'GBP', 'INR', 'JPY'])
+
+    # Weekly histories and current rates are independent, so request them
+    # all at once and give up on whatever is late.
+    weekly_futures = [(currency,
+                       asyncio.ensure_future(client.get_weekly(currency)))
+                      for currency in currencies]
+    current_future = asyncio.ensure_future(client.get_current_top8("JPY"))
+    _, not_done = await asyncio.wait(
+        [f for _, f in weekly_futures] + [current_future],
+        timeout=config.get('timeout', 20))
+    for future in not_done:
+        future.cancel()
+
+    attachments = []
+
+    # Currency rates for past one week
+    histories = []
+    failed_currencies = []
+    for currency, future in weekly_futures:
+        if future in not_done:
+            logging.error("Weekly history of %s timed out.", currency)
+            failed_currencies.append(currency)
+            continue
+
+        try:
+            data = future.result()
+            histories.append((
+                currency,
+                [daily['dateCurrencyRate'] for daily in data['currencies']],
+                [daily['amountTo'] for daily in data['currencies']]))
+        except Exception as e:
+            logging.error("Weekly history of %s is not available. %s",
+                          currency, e)
+            failed_currencies.append(currency)
+
+    if histories:
+        try:
+            storage = create_storage(config)
+            if storage:
+                # Render in-process instead of uploading to plot.ly
+                weekly_plot_url = await to_thread(
+                    ChartRenderer(storage).lines, histories)
+                weekly_image_url = weekly_plot_url
+            else:
+                with metrics.timer('currency', 'upload'):
+                    weekly_plot_url = await to_thread(plot_histories,
+                                                      histories)
+                weekly_image_url = weekly_plot_url + ".png"
+        except Exception as e:
+            logging.error(e)
+        else:
+            attachments.append(
+                MessageAttachment(fallback="Currency rate history",
+                                  pretext="Currency rate history",
+                                  title="Base currency: USD",
+                                  title_link=weekly_plot_url,
+                                  image_url=weekly_image_url))
+
+    if failed_currencies:
+        message = "Currency rate history is not available for %s" % \
+                  ", ".join(failed_currencies)
+        attachments.append(MessageAttachment(fallback=message,
+                                             title=message,
+                                             color="#FF0000"))
+
+    # Add current rates
+    fields = []
+    try:
+        if current_future in not_done:
+            raise Exception("Current rates timed out.")
+        current_top8 = current_future.result()
         fields = [AttachmentField(r['to'],
                                   "%.4f" % (float(1)/r['rate']),
                                   True)
                   for r in current_top8['rates']]
+    except Exception as e:
+        logging.error(e)
+    else:
+        title = "Base currency: JPY."
+        age = breaker.stale_age(current_top8)
+        if age is not None:
+            title += " " + breaker.age_marker(age)
         attachments.append(MessageAttachment(fallback="Current currency rate",
                                              pretext="Current currency rate",
-                                             title="Base currency: JPY.",
+                                             title=title,
                                              fields=fields))
 
-        return SlackMessage(
-            text="Summary Report",
-            attachments=attachments)
-    except:
+    if not histories and not fields:
+        # Nothing but error notes to report
         return "Something went wrong"
+
+    return SlackMessage(
+        text="Summary Report",
+        attachments=attachments)
@@ -1,19 +1,140 @@
 # -*- coding: utf-8 -*-
 import logging
-import flickrapi
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 from sarah.bot.slack import Slack, MessageAttachment, SlackMessage
-from typing import Dict, Optional
+from sarah_plugins import metrics, ratelimit
+from typing import Dict, Optional, Sequence, Tuple
+
+# (location_name, location_url)
+Location = Tuple[Optional[str], Optional[str]]
+
+
+class PhotoLocationCache(object):
+    # Persists resolved locations, and photos known to have none, across
+    # scheduled runs and bot restarts.
+    def __init__(self,
+                 path: str,
+                 ttl: float=30 * 24 * 60 * 60,
+                 negative_ttl: float=24 * 60 * 60):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.__connection = sqlite3.connect(path)
+        with self.__connection:
+            self.__connection.execute(
+                "CREATE TABLE IF NOT EXISTS photo_location ("
+                "photo_id TEXT PRIMARY KEY, "
+                "location_name TEXT, "
+                "location_url TEXT, "
+                "expires_at REAL NOT NULL)")
+            self.__connection.execute(
+                "DELETE FROM photo_location WHERE expires_at <= ?",
+                (time.time(),))
+
+    def get_many(self, photo_ids: Sequence[str]) -> Dict[str, Location]:
+        if not photo_ids:
+            return dict()
+
+        cursor = self.__connection.execute(
+            "SELECT photo_id, location_name, location_url "
+            "FROM photo_location "
+            "WHERE photo_id IN (%s) AND expires_at > ?" %
+            ", ".join("?" * len(photo_ids)),
+            list(photo_ids) + [time.time()])
+        return {row[0]: (row[1], row[2]) for row in cursor}
+
+    def set(self,
+            photo_id: str,
+            location_name: Optional[str],
+            location_url: Optional[str]) -> None:
+        ttl = self.ttl if location_name else self.negative_ttl
+        with self.__connection:
+            self.__connection.execute(
+                "INSERT OR REPLACE INTO photo_location "
+                "(photo_id, location_name, location_url, expires_at) "
+                "VALUES (?, ?, ?, ?)",
+                (photo_id, location_name, location_url, time.time() + ttl))
+
+    def close(self) -> None:
+        self.__connection.close()
+
+
+def retrieve_location(flickr: 'flickrapi.FlickrAPI',
+                      photo_id: str,
+                      priority: str=ratelimit.COMMAND,
+                      deadline: float=None) -> Location:
+    # Returns (None, None) when Flickr says the photo has no location, which
+    # is worth caching, and raises on any other error, which is not.
+    # Past the deadline, a time.monotonic() value, the result would be
+    # thrown away, so no quota is spent on it.
+    from flickrapi import FlickrError
+    max_wait = None
+    if deadline is not None:
+        max_wait = deadline - time.monotonic()
+        if max_wait <= 0:
+            raise TimeoutError("Location of %s is no longer needed" %
+                               photo_id)
+
+    try:
+        # https://gist.github.com/anonymous/1861a9dcc96848848cbf
+        # geo_response = flickr.do_flickr_call(
+        #     "flickr.photos.geo.getLocation",
+        #     photo_id=p['id'])
+        ratelimit.acquire('flickr', priority, max_wait)
+        with metrics.timer('flickr', 'upstream'):
+            geo_response = flickr.photos_geo_getLocation(photo_id=photo_id)
+        location = geo_response['photo']['location']
+        lat = location['latitude']
+        lon = location['longitude']
+        # accuracy = location['accuracy']
+    except FlickrError as e:
+        # flickrapi raises on {"stat": "fail"}. Code 2 is
+        # "Photo has no location information."
+        if e.code == 2:
+            logging.info("Location API Error: %s", e)
+            return None, None
+        logging.error("Location API Error: %s", e)
+        raise
+    except KeyError as e:
+        logging.error("Error on retrieving photo location. %s" % e)
+        raise
+    except Exception as e:
+        logging.error("Location API Error: %s", e)
+        raise
+
+    # If stringified location fragments are provided, construct a name
+    # from them.
+    location_name = ", ".join(
+        filter(None,
+               [location.get(k, {}).get('_content', None) for k
+                in ['locality', 'county', 'region', 'country']]))
+    if not location_name:
+        location_name = ", ".join([lat, lon])
+
+    location_url = "https://www.flickr.com/map/" \
+                   "?fLat=%s&fLon=%s&zl=13&everyone_nearby=1" % (lat, lon)
+
+    return location_name, location_url
 
 
 @Slack.schedule('flickr_interesting_photos')
+@metrics.timed('flickr', 'schedule')
 def interesting_pictures(config: Dict) -> Optional[SlackMessage]:
-    # Setup client module
+    # Setup client module. Imported here so that loading the plugin doesn't
+    # pull in flickrapi and its dependencies until the schedule first runs.
+    import flickrapi
     flickr = flickrapi.FlickrAPI(config['api_key'],
                                  config['api_secret'],
                                  format="parsed-json")
+    if 'rest_url' in config:
+        flickr.REST_URL = config['rest_url']
     # Retrieve top interesting photos
+    ratelimit.configure(config.get('rate_limits', {}))
     try:
-        response = flickr.interestingness_getList()
+        ratelimit.acquire('flickr', ratelimit.SCHEDULE)
+        with metrics.timer('flickr', 'upstream'):
+            response = flickr.interestingness_getList()
         # parsed = json.loads(response.decode('utf-8'))
         if response['stat'] != "ok":
             raise Exception("API status error")
@@ -30,46 +151,52 @@ def interesting_pictures(config: Dict) -> Optional[SlackMessage]:
             return
 
     # Retrieve location information for each photo
-    # I want some sort of "bulk" API like the one Facebook has...
+    # Most of the list overlaps with the previous run, so only photos that
+    # are not in the persistent cache are looked up.
+    location_cache = PhotoLocationCache(
+        config.get('location_cache_path', "flickr_location_cache.sqlite3"),
+        config.get('location_cache_ttl', 30 * 24 * 60 * 60),
+        config.get('location_cache_negative_ttl', 24 * 60 * 60))
+    try:
+        locations = location_cache.get_many([p['id'] for p in photos])
+        uncached_ids = [p['id'] for p in photos if p['id'] not in locations]
+        metrics.count_cache('flickr.location',
+                            hits=len(locations),
+                            misses=len(uncached_ids))
+
+        # I want some sort of "bulk" API like the one Facebook has...
+        # Until then, fan the requests out to a bounded pool and give up on
+        # whatever is not resolved within the time budget.
+        if uncached_ids:
+            geo_timeout = config.get('geo_timeout', 10)
+            deadline = time.monotonic() + geo_timeout
+            executor = ThreadPoolExecutor(
+                max_workers=config.get('geo_concurrency', 5))
+            futures = {photo_id: executor.submit(retrieve_location,
+                                                 flickr,
+                                                 photo_id,
+                                                 ratelimit.SCHEDULE,
+                                                 deadline)
+                       for photo_id in uncached_ids}
+            _, not_done = wait(futures.values(), timeout=geo_timeout)
+            for future in not_done:
+                future.cancel()
+            executor.shutdown(wait=False)
+            if not_done:
+                logging.error("Location API timed out for %d photo(s).",
+                              len(not_done))
+
+            for photo_id, future in futures.items():
+                if future in not_done or future.exception():
+                    continue
+                locations[photo_id] = future.result()
+                location_cache.set(photo_id, *locations[photo_id])
+    finally:
+        location_cache.close()
+
     attachments = []
     for p in photos:
-        location_url = None
-        location_name = None
-        try:
-            # https://gist.github.com/anonymous/1861a9dcc96848848cbf
-            # geo_response = flickr.do_flickr_call(
-            #     "flickr.photos.geo.getLocation",
-            #     photo_id=p['id'])
-            geo_response = flickr.photos_geo_getLocation(photo_id=p['id'])
-            if geo_response['stat'] != "ok":
-                # Skip if no location is registered.
-                # {"stat":"fail",
-                #  "code":2,
-                #  "message": "Photo has no location information."}
-                raise Exception(geo_response.get('message',
-                                                 "API Response error."))
-
-            location = geo_response['photo']['location']
-            lat = location['latitude']
-            lon = location['longitude']
-            # accuracy = location['accuracy']
-        except KeyError as e:
-            logging.error("Error on retrieving photo location. %s" % e)
-        except Exception as e:
-            logging.error("Location API Error: %s", e)
-        else:
-            # If stringified location fragments are provided, construct a name
-            # from them.
-            location_name = ", ".join(
-                filter(None,
-                       [location.get(k, {}).get('_content', None) for k
-                        in ['locality', 'county', 'region', 'country']]))
-            if not location_name:
-                location_name = ", ".join([lat, lon])
-
-            location_url = "https://www.flickr.com/map/" \
-                           "?fLat=%s&fLon=%s&zl=13&everyone_nearby=1" % (lat,
-                                                                         lon)
+        location_name, location_url = locations.get(p['id'], (None, None))
 
         attachments.append(MessageAttachment(
             fallback=p['title'],
@@ -1,60 +1,227 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import hashlib
+import io
 import logging
-import feedparser
-import requests
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from xml.etree.ElementTree import ParseError, iterparse
 from sarah import ValueObject
 from sarah.bot.hipchat import HipChat
 
 from sarah.bot.slack import Slack, SlackMessage, MessageAttachment, \
     AttachmentField
 from sarah.bot.values import CommandMessage, UserContext, InputOption
-from typing import Dict, Sequence, Union
+from sarah_plugins import aio, metrics, ratelimit
+from sarah_plugins.aio import synchronize, to_thread
+from typing import Dict, List, Optional, Sequence, Union
+
+
+class Entry(namedtuple('Entry',
+                       ('link', 'title', 'summary', 'bookmark_count'))):
+    # A plain tuple: no per-instance dict, hashable and compared by value.
+    __slots__ = ()
+
+
+def fingerprint(entries: Sequence[Entry]) -> str:
+    # Digest of every field shown in messages and gists, so two feeds with
+    # the same fingerprint render the same.
+    return hashlib.sha1("\x1e".join(
+        "\x1f".join((e.link, e.title, e.summary, str(e.bookmark_count)))
+        for e in entries).encode()).hexdigest()
+
+
+RDF_TAG = "{http://www.w3.org/1999/02/22-rdf-syntax-ns#}RDF"
+ITEM_TAG = "{http://purl.org/rss/1.0/}item"
+# Element of an item => field of Entry
+ITEM_FIELD_TAGS = {
+    "{http://purl.org/rss/1.0/}link": 'link',
+    "{http://purl.org/rss/1.0/}title": 'title',
+    "{http://purl.org/rss/1.0/}description": 'summary',
+    "{http://www.hatena.ne.jp/info/xmlns#}bookmarkcount": 'bookmark_count'}
+
+
+def parse_hatena_rss(content: bytes, limit: int=None) -> List[Entry]:
+    # Reads Hatena's RSS 1.0 one item at a time, keeping only the fields of
+    # Entry, and stops reading once limit items are collected. Unlike
+    # feedparser, descriptions are taken as is without HTML sanitizing.
+    # Raises ValueError on anything else so the caller can fall back.
+    entries = []
+    fields = None
+    events = iterparse(io.BytesIO(content), events=('start', 'end'))
+    try:
+        _, root = next(events)
+        if root.tag != RDF_TAG:
+            raise ValueError("Unexpected root element %s" % root.tag)
+
+        for event, element in events:
+            if element.tag == ITEM_TAG:
+                if event == 'start':
+                    fields = dict()
+                    continue
+
+                try:
+                    entries.append(Entry(fields['link'],
+                                         fields['title'],
+                                         fields['summary'],
+                                         int(fields['bookmark_count'])))
+                except KeyError as e:
+                    raise ValueError("Item without %s" % e)
+                fields = None
+                # Drop parsed items so memory stays flat.
+                root.clear()
+                if limit is not None and len(entries) >= limit:
+                    break
+            elif event == 'end' and fields is not None and \
+                    element.tag in ITEM_FIELD_TAGS:
+                fields[ITEM_FIELD_TAGS[element.tag]] = \
+                    (element.text or "").strip()
+    except (ParseError, StopIteration) as e:
+        raise ValueError("Malformed feed. %s" % e)
+
+    return entries
+
+
+class Feed(object):
+    # Fingerprinted once on construction; comparing two feeds or checking a
+    # feed against the posted gist is then a single string comparison.
+    __slots__ = ('category', 'entries', 'fingerprint')
+
+    def __init__(self,
+                 category: str,
+                 entries: Sequence[Entry]):
+        self.category = category
+        self.entries = tuple(entries)
+        self.fingerprint = fingerprint(self.entries)
+
+    def __eq__(self, other) -> bool:
+        return (isinstance(other, Feed) and
+                self.category == other.category and
+                self.fingerprint == other.fingerprint)
+
+    def __ne__(self, other) -> bool:
+        return not self == other
+
+    def __hash__(self) -> int:
+        return hash((self.category, self.fingerprint))
+
+    def __repr__(self) -> str:
+        return "Feed(category=%r, entries=<%d>, fingerprint=%r)" % (
+            self.category, len(self.entries), self.fingerprint)
 
 
-class Entry(ValueObject):
+class CachedContent(namedtuple('CachedContent',
+                               ('category',
+                                'gist_id',
+                                'gist_url',
+                                'content_digest'))):
+    # content_digest is the fingerprint of the feed posted to the gist.
+    __slots__ = ()
+
+
+class Snapshot(ValueObject):
     def __init__(self,
-                 link: str,
-                 title: str,
-                 summary: str,
-                 bookmark_count: int):
+                 feed: Feed,
+                 gist_url: str,
+                 refreshed_at: float):
         pass
 
     @property
-    def link(self) -> str:
-        return self['link']
-
-    @property
-    def title(self) -> str:
-        return self['title']
+    def feed(self) -> Feed:
+        return self['feed']
 
     @property
-    def summary(self) -> str:
-        return self['summary']
+    def gist_url(self) -> str:
+        return self['gist_url']
 
     @property
-    def bookmark_count(self) -> int:
-        return self['bookmark_count']
+    def refreshed_at(self) -> float:
+        return self['refreshed_at']
 
 
-class Feed(ValueObject):
+class FeedBatch(ValueObject):
     def __init__(self,
-                 category: str,
-                 entries: Sequence[Entry]):
+                 feeds: Dict[str, Feed],
+                 errors: Dict[str, str]):
         pass
 
     @property
-    def category(self) -> str:
-        return self['category']
+    def feeds(self) -> Dict[str, Feed]:
+        return self['feeds']
 
     @property
-    def entries(self) -> Sequence[Entry]:
-        return self['entries']
-
-
-class CachedContent(ValueObject):
+    def errors(self) -> Dict[str, str]:
+        return self['errors']
+
+    def top_entries(self, limit: int=10) -> Sequence[Entry]:
+        # The same entry may be listed in hotentry and its own category.
+        entries = dict()
+        for feed in self.feeds.values():
+            for entry in feed.entries:
+                entries.setdefault(entry.link, entry)
+
+        return sorted(entries.values(),
+                      key=lambda e: e.bookmark_count,
+                      reverse=True)[:limit]
+
+
+class GistApiError(Exception):
+    # GitHub refused to create or update a gist, e.g. bad token or quota.
+    pass
+
+
+class GistCache(object):
+    # Remembers the gist posted for each category. Backed by SQLite so the
+    # same gists are updated across bot restarts instead of new ones piling
+    # up. Everything is read into memory on first use.
+    def __init__(self, path: str):
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__connection = None
+        self.__contents = None
+
+    def __load(self) -> Dict[str, CachedContent]:
+        if self.__contents is None:
+            self.__connection = sqlite3.connect(self.path,
+                                                check_same_thread=False)
+            with self.__connection:
+                self.__connection.execute(
+                    "CREATE TABLE IF NOT EXISTS hateb_gist ("
+                    "category TEXT PRIMARY KEY, "
+                    "gist_id TEXT NOT NULL, "
+                    "gist_url TEXT NOT NULL, "
+                    "content_digest TEXT NOT NULL)")
+            cursor = self.__connection.execute(
+                "SELECT category, gist_id, gist_url, content_digest "
+                "FROM hateb_gist")
+            self.__contents = {row[0]: CachedContent(*row) for row in cursor}
+        return self.__contents
+
+    def get(self, category: str) -> Optional[CachedContent]:
+        with self.__lock:
+            return self.__load().get(category, None)
+
+    def set(self, content: CachedContent) -> None:
+        with self.__lock:
+            self.__load()[content.category] = content
+            with self.__connection:
+                self.__connection.execute(
+                    "INSERT OR REPLACE INTO hateb_gist "
+                    "(category, gist_id, gist_url, content_digest) "
+                    "VALUES (?, ?, ?, ?)",
+                    (content.category,
+                     content.gist_id,
+                     content.gist_url,
+                     content.content_digest))
+
+
+class FeedState(ValueObject):
     def __init__(self,
                  feed: Feed,
-                 gist_url: str):
+                 etag: Optional[str]=None,
+                 last_modified: Optional[str]=None):
         pass
 
     @property
@@ -62,13 +229,83 @@ class CachedContent(ValueObject):
         return self['feed']
 
     @property
-    def gist_url(self) -> str:
-        return self['gist_url']
+    def etag(self) -> Optional[str]:
+        return self['etag']
+
+    @property
+    def last_modified(self) -> Optional[str]:
+        return self['last_modified']
+
+
+class FeedDiff(ValueObject):
+    def __init__(self,
+                 added: Sequence[Entry],
+                 updated: Sequence[Entry],
+                 removed: Sequence[Entry]):
+        pass
+
+    @property
+    def added(self) -> Sequence[Entry]:
+        return self['added']
+
+    @property
+    def updated(self) -> Sequence[Entry]:
+        # Entries whose bookmark count changed since the previous retrieval
+        return self['updated']
+
+    @property
+    def removed(self) -> Sequence[Entry]:
+        return self['removed']
+
+    @property
+    def has_changes(self) -> bool:
+        return bool(self.added or self.updated or self.removed)
+
+
+def diff_feeds(old_feed: Optional[Feed], new_feed: Feed) -> FeedDiff:
+    if old_feed and old_feed.fingerprint == new_feed.fingerprint:
+        return FeedDiff([], [], [])
+
+    old_entries = {e.link: e for e in old_feed.entries} if old_feed else {}
+    new_links = set()
+    added = []
+    updated = []
+    for entry in new_feed.entries:
+        new_links.add(entry.link)
+        old_entry = old_entries.get(entry.link, None)
+        if old_entry is None:
+            added.append(entry)
+        elif old_entry.bookmark_count != entry.bookmark_count:
+            updated.append(entry)
+
+    removed = [e for e in old_entries.values() if e.link not in new_links]
+
+    return FeedDiff(added, updated, removed)
 
 
 class Hateb(object):
-    def __init__(self):
-        self.__cached_content = None
+    def __init__(self,
+                 gist_cache_path: str="hateb_gist_cache.sqlite3",
+                 gist_api_url: str="https://api.github.com/gists",
+                 feed_base_url: str="http://b.hatena.ne.jp/",
+                 fast_parser: bool=True,
+                 max_entries: int=None):
+        self.gist_api_url = gist_api_url
+        self.feed_base_url = feed_base_url
+        # max_entries keeps only the top of each feed, in Hatena's order;
+        # gists and diffs then cover those entries only.
+        self.fast_parser = fast_parser
+        self.max_entries = max_entries
+        self.__gist_cache = GistCache(gist_cache_path)
+        self.__feed_states = dict()
+        self.__feed_diffs = dict()
+        self.__snapshots = dict()
+
+    def configure(self, gist_cache_path: str) -> None:
+        # Called with the plugin's config on every run, so the module level
+        # instance follows gist_cache_path without losing feeds in memory.
+        if gist_cache_path != self.__gist_cache.path:
+            self.__gist_cache = GistCache(gist_cache_path)
 
     @property
     def allowed_categories(self) -> Sequence[str]:
@@ -78,70 +315,326 @@ class Hateb(object):
     def feed_map(self) -> Dict:
         # Be careful, hotentry has original format of hotentry.rss
         # while the others have hotentry/{CATEGORY}.rss.
-        return {'hotentry': "http://b.hatena.ne.jp/hotentry.rss",
-                'general': "http://b.hatena.ne.jp/hotentry/general.rss",
-                'social': "http://b.hatena.ne.jp/hotentry/social.rss",
-                'economics': "http://b.hatena.ne.jp/hotentry/economics.rss",
-                'life': "http://b.hatena.ne.jp/hotentry/life.rss",
-                'knowledge': "http://b.hatena.ne.jp/hotentry/knowledge.rss",
-                'it': "http://b.hatena.ne.jp/hotentry/it.rss",
-                'fun': "http://b.hatena.ne.jp/hotentry/fun.rss",
-                'entertainment': "http://b.hatena.ne.jp/hotentry/entertainment.rss",
-                'game': "http://b.hatena.ne.jp/hotentry/game.rss"}
-
-    def retrieve_feed(self, category: str) -> Feed:
-        feed_url = self.feed_map[category]
-        result = feedparser.parse(feed_url)
-
-        if result['status'] != 200:
-            logging.error('Response status: %d', result['status'])
-            return 'Response status: %s' % result['status']
-
-        return Feed(category=category,
-                    entries=[Entry(e['link'],
-                                   e['title'],
-                                   e['summary'],
-                                   int(e['hatena_bookmarkcount']))
-                             for e in result['entries']])
-
-    def is_new(self, feed: Feed) -> bool:
-        if self.__cached_content:
-            return self.__cached_content.feed != feed
+        feed_map = {'hotentry': "%shotentry.rss" % self.feed_base_url}
+        for category in ('general', 'social', 'economics', 'life',
+                         'knowledge', 'it', 'fun', 'entertainment', 'game'):
+            feed_map[category] = "%shotentry/%s.rss" % (self.feed_base_url,
+                                                        category)
+        return feed_map
+
+    def feed_request_headers(self, category: str) -> Dict[str, str]:
+        # Let the server answer 304 when nothing changed since the last
+        # retrieval, so neither the body nor the parse is paid again.
+        headers = dict()
+        state = self.__feed_states.get(category, None)
+        if state:
+            if state.etag:
+                headers['If-None-Match'] = state.etag
+            if state.last_modified:
+                headers['If-Modified-Since'] = state.last_modified
+        return headers
+
+    def read_feed(self,
+                  category: str,
+                  status_code: int,
+                  headers: Dict[str, str],
+                  content: bytes) -> Union[Feed, str]:
+        state = self.__feed_states.get(category, None)
+        if status_code == 304 and state:
+            metrics.count_cache('hateb.feed', hits=1)
+            self.__feed_diffs[category] = FeedDiff([], [], [])
+            return state.feed
+
+        metrics.count_cache('hateb.feed', misses=1)
+        if status_code != 200:
+            logging.error('Response status: %d', status_code)
+            metrics.count_error('hateb', 'upstream', "HTTP %d" % status_code)
+            return 'Response status: %s' % status_code
+
+        with metrics.timer('hateb', 'decode'):
+            feed = Feed(category=category,
+                        entries=self.parse_entries(content, headers))
+
+        self.__feed_diffs[category] = diff_feeds(
+            state.feed if state else None, feed)
+        self.__feed_states[category] = FeedState(
+            feed,
+            headers.get('ETag', None),
+            headers.get('Last-Modified', None))
+
+        return feed
+
+    def parse_entries(self,
+                      content: bytes,
+                      headers: Dict[str, str]) -> Sequence[Entry]:
+        # The fast path trusts the XML declaration for the encoding, so it
+        # is skipped when the server says otherwise.
+        content_type = headers.get('Content-Type', "").lower()
+        if self.fast_parser and ("charset" not in content_type or
+                                 "charset=utf-8" in content_type):
+            try:
+                return parse_hatena_rss(content, self.max_entries)
+            except ValueError as e:
+                logging.warning("Falling back to feedparser. %s", e)
+                metrics.count_error('hateb', 'decode', e)
+
+        # Only needed for the fallback, so imported on first use.
+        import feedparser
+        result = feedparser.parse(content, response_headers=dict(headers))
+        return [Entry(e['link'],
+                      e['title'],
+                      e['summary'],
+                      int(e['hatena_bookmarkcount']))
+                for e in result['entries'][:self.max_entries]]
+
+    async def retrieve_feed(self, category: str) -> Feed:
+        with metrics.timer('hateb', 'upstream'):
+            response = await aio.get(
+                self.feed_map[category],
+                headers=self.feed_request_headers(category))
+        # Parsing is CPU bound; keep it off the event loop.
+        return await to_thread(self.read_feed,
+                               category,
+                               response.status_code,
+                               response.headers,
+                               response.content)
+
+    async def retrieve_feeds(self,
+                             categories: Sequence[str],
+                             max_workers: int=5) -> FeedBatch:
+        semaphore = asyncio.Semaphore(max_workers)
+
+        async def retrieve(category: str) -> Feed:
+            async with semaphore:
+                return await self.retrieve_feed(category)
+
+        results = await asyncio.gather(*[retrieve(category)
+                                         for category in categories],
+                                       return_exceptions=True)
+
+        feeds = dict()
+        errors = dict()
+        for category, feed in zip(categories, results):
+            if isinstance(feed, Feed):
+                feeds[category] = feed
+            elif isinstance(feed, Exception):
+                logging.error("Failed to retrieve %s. %s", category, feed)
+                errors[category] = str(feed)
+            else:
+                errors[category] = feed
+
+        return FeedBatch(feeds, errors)
+
+    def feed_diff(self, category: str) -> Optional[FeedDiff]:
+        # Difference between the last two retrievals of the category
+        return self.__feed_diffs.get(category, None)
+
+    @staticmethod
+    def gist_content(feed: Feed) -> str:
+        return '\n'.join(
+            ['- [%s](%s) (%d)  \n%s  ' % (e.title,
+                                          e.link,
+                                          e.bookmark_count,
+                                          e.summary)
+             for e in feed.entries])
+
+    async def cached_gist(self, category: str) -> Optional[CachedContent]:
+        # The first lookup reads SQLite; keep it off the event loop.
+        return await to_thread(self.__gist_cache.get, category)
+
+    async def is_new(self, feed: Feed) -> bool:
+        cached_content = await self.cached_gist(feed.category)
+        if cached_content:
+            return cached_content.content_digest != feed.fingerprint
         else:
             return True
 
-    def post_gist(self, feed: Feed) -> str:
-        if self.is_new(feed):
-            content = '\n'.join(
-                ['- [%s](%s) (%d)  \n%s  ' % (e.title,
-                                              e.link,
-                                              e.bookmark_count,
-                                              e.summary)
-                 for e in feed.entries])
-
-            response = requests.post(
-                'https://api.github.com/gists',
-                json={'description': "hot entry",
-                      'public': False,
-                      'files': {'entries.md': {'content': content}}})
-
-            gist_url = response.json()['html_url']
-            self.__cached_content = CachedContent(feed, gist_url)
-
-            return gist_url
-        else:
-            return self.__cached_content.gist_url
+    @staticmethod
+    def gist_headers(github_token: str=None) -> Dict[str, str]:
+        headers = dict()
+        if github_token:
+            headers['Authorization'] = "token %s" % github_token
+        return headers
+
+    @staticmethod
+    def gist_payload(content: str) -> Dict:
+        return {'description': "hot entry",
+                'files': {'entries.md': {'content': content}}}
+
+    async def save_gist(self,
+                        category: str,
+                        content_digest: str,
+                        decoded_content: Dict) -> str:
+        gist_url = decoded_content['html_url']
+        await to_thread(self.__gist_cache.set,
+                        CachedContent(category,
+                                      decoded_content['id'],
+                                      gist_url,
+                                      content_digest))
+        return gist_url
+
+    async def post_gist(self,
+                        feed: Feed,
+                        github_token: str=None,
+                        priority: str=ratelimit.COMMAND) -> str:
+        cached_content = await self.cached_gist(feed.category)
+        if cached_content and \
+                cached_content.content_digest == feed.fingerprint:
+            metrics.count_cache('hateb.gist', hits=1)
+            return cached_content.gist_url
+        metrics.count_cache('hateb.gist', misses=1)
+
+        headers = self.gist_headers(github_token)
+        payload = self.gist_payload(self.gist_content(feed))
+
+        # Anonymous gists can not be edited, so a token is required to
+        # update the category's gist in place.
+        response = None
+        if cached_content and github_token:
+            await ratelimit.acquire_async('github', priority)
+            with metrics.timer('hateb', 'upload'):
+                response = await aio.patch(
+                    "%s/%s" % (self.gist_api_url, cached_content.gist_id),
+                    json=payload,
+                    headers=headers)
+            if response.status_code == 404:
+                # Deleted on GitHub. Create a new one below.
+                response = None
+
+        if response is None:
+            payload['public'] = False
+            await ratelimit.acquire_async('github', priority)
+            with metrics.timer('hateb', 'upload'):
+                response = await aio.post(self.gist_api_url,
+                                          json=payload,
+                                          headers=headers)
+
+        decoded_content = self.decode_gist_response(response)
+
+        return await self.save_gist(feed.category,
+                                    feed.fingerprint,
+                                    decoded_content)
+
+    @staticmethod
+    def decode_gist_response(response: aio.AsyncResponse) -> Dict:
+        # 200 on update and 201 on creation; anything else carries GitHub's
+        # reason in "message".
+        try:
+            decoded_content = response.json()
+        except ValueError:
+            decoded_content = dict()
+        if response.status_code not in (200, 201) or \
+                'html_url' not in decoded_content:
+            metrics.count_error('hateb', 'upload',
+                                "HTTP %d" % response.status_code)
+            raise GistApiError("Gist API responded %d. %s" % (
+                response.status_code,
+                decoded_content.get('message', response.content[:200])))
+        return decoded_content
+
+    def snapshot(self, category: str) -> Optional[Snapshot]:
+        return self.__snapshots.get(category, None)
+
+    def store_snapshot(self, feed: Feed, gist_url: str) -> Snapshot:
+        snapshot = Snapshot(feed, gist_url, time.time())
+        self.__snapshots[feed.category] = snapshot
+        return snapshot
+
+    def fresh_snapshot(self,
+                       category: str,
+                       max_age: float=300) -> Optional[Snapshot]:
+        snapshot = self.snapshot(category)
+        if snapshot and time.time() - snapshot.refreshed_at < max_age:
+            metrics.count_cache('hateb.snapshot', hits=1)
+            return snapshot
+        metrics.count_cache('hateb.snapshot', misses=1)
+        return None
+
+    async def refresh(self,
+                      category: str,
+                      github_token: str=None,
+                      priority: str=ratelimit.COMMAND) -> Snapshot:
+        feed = await self.retrieve_feed(category)
+        if not isinstance(feed, Feed):
+            raise Exception(feed)
+
+        return self.store_snapshot(
+            feed, await self.post_gist(feed, github_token, priority))
+
+    async def refresh_all(self, github_token: str=None) -> None:
+        for category in self.allowed_categories:
+            try:
+                await self.refresh(category,
+                                   github_token,
+                                   ratelimit.SCHEDULE)
+            except Exception as e:
+                # Previous snapshot, if any, is kept and served as is.
+                logging.error("Failed to refresh %s. %s", category, e)
+
+    async def hot_entries(self,
+                          category: str,
+                          github_token: str=None,
+                          max_age: float=300) -> Snapshot:
+        snapshot = self.fresh_snapshot(category, max_age)
+        if snapshot:
+            return snapshot
+
+        snapshot = self.snapshot(category)
+        try:
+            return await self.refresh(category, github_token)
+        except Exception as e:
+            if snapshot:
+                # Stale-while-revalidate: better old entries than an error.
+                logging.error("Serving stale %s. %s", category, e)
+                return snapshot
+            raise
 
 
 hateb = Hateb()
 
 
 @Slack.command('.hateb')
-def slack_hateb(msg: CommandMessage,
-                _: Dict) -> Union[str, UserContext]:
-    if msg.text in hateb.allowed_categories:
-        feed = hateb.retrieve_feed(msg.text)
-        gist_url = hateb.post_gist(feed)
+@synchronize
+@metrics.timed('hateb')
+async def slack_hateb(msg: CommandMessage,
+                      config: Dict) -> Union[str, UserContext, SlackMessage]:
+    if msg.text == "all":
+        batch = await hateb.retrieve_feeds(hateb.allowed_categories,
+                                           config.get('max_workers', 5))
+        attachments = [
+            MessageAttachment(
+                fallback="[%d] %s : %s" % (e.bookmark_count,
+                                           e.title,
+                                           e.link),
+                fields=[AttachmentField(title="Bookmark Count",
+                                        value=str(e.bookmark_count))],
+                title_link=e.link,
+                title=e.title,
+                color="#00FF00")
+            for e in batch.top_entries(config.get('top_n', 10))]
+
+        if batch.errors:
+            message = "Failed to retrieve: %s" % ", ".join(
+                sorted(batch.errors.keys()))
+            attachments.append(MessageAttachment(fallback=message,
+                                                 title=message,
+                                                 color="#FF0000"))
+
+        return SlackMessage(text="Category: all", attachments=attachments)
+    elif msg.text in hateb.allowed_categories:
+        ratelimit.configure(config.get('rate_limits', {}))
+        hateb.configure(config.get('gist_cache_path',
+                                   "hateb_gist_cache.sqlite3"))
+        try:
+            snapshot = await hateb.hot_entries(
+                msg.text,
+                config.get('github_token', None),
+                config.get('max_age', 300))
+        except Exception as e:
+            logging.error(e)
+            return "Something went wrong with %s" % msg.text
+        feed = snapshot.feed
+        gist_url = snapshot.gist_url
 
         attachments = [
             MessageAttachment(
@@ -163,18 +656,45 @@ def slack_hateb(msg: CommandMessage,
                             attachments=attachments)
     else:
         message = ("Please choose a category from below:\n%s" %
-                   ", ".join(hateb.allowed_categories))
+                   ", ".join(list(hateb.allowed_categories) + ["all"]))
         return UserContext(message=message,
                            help_message=message,
                            input_options=(InputOption(".", slack_hateb),))
 
 
 @HipChat.command('.hateb')
-def hipchat_hateb(msg: CommandMessage,
-                  _: Dict) -> Union[str, UserContext]:
-    if msg.text in hateb.allowed_categories:
-        feed = hateb.retrieve_feed(msg.text)
-        gist_url = hateb.post_gist(feed)
+@synchronize
+@metrics.timed('hateb')
+async def hipchat_hateb(msg: CommandMessage,
+                        config: Dict) -> Union[str, UserContext]:
+    if msg.text == "all":
+        batch = await hateb.retrieve_feeds(hateb.allowed_categories,
+                                           config.get('max_workers', 5))
+        list_string = '\n'.join(
+            ['[%d] %s : %s' % (e.bookmark_count,
+                               e.title,
+                               e.link)
+             for e in batch.top_entries(config.get('top_n', 10))])
+
+        if batch.errors:
+            list_string += '\n\n Failed to retrieve: %s' % ", ".join(
+                sorted(batch.errors.keys()))
+
+        return list_string
+    elif msg.text in hateb.allowed_categories:
+        ratelimit.configure(config.get('rate_limits', {}))
+        hateb.configure(config.get('gist_cache_path',
+                                   "hateb_gist_cache.sqlite3"))
+        try:
+            snapshot = await hateb.hot_entries(
+                msg.text,
+                config.get('github_token', None),
+                config.get('max_age', 300))
+        except Exception as e:
+            logging.error(e)
+            return "Something went wrong with %s" % msg.text
+        feed = snapshot.feed
+        gist_url = snapshot.gist_url
 
         # Multi-line message is folded by default, so entries are not spliced.
         list_string = '\n'.join(
@@ -185,7 +705,30 @@ def hipchat_hateb(msg: CommandMessage,
         return '%s\n\n Detail: %s' % (list_string, gist_url)
     else:
         message = ("Please choose a category from below:\n%s" %
-                   ", ".join(hateb.allowed_categories))
+                   ", ".join(list(hateb.allowed_categories) + ["all"]))
         return UserContext(message=message,
                            help_message=message,
                            input_options=(InputOption(".", hipchat_hateb),))
+
+
+# Opt-in background refresher. Enable one of these schedules so every
+# category is kept warm and .hateb answers from memory; set the command's
+# max_age above the schedule interval.
+@Slack.schedule('hateb_prefetch')
+@synchronize
+@metrics.timed('hateb', 'schedule')
+async def slack_hateb_prefetch(config: Dict) -> None:
+    ratelimit.configure(config.get('rate_limits', {}))
+    hateb.configure(config.get('gist_cache_path',
+                               "hateb_gist_cache.sqlite3"))
+    await hateb.refresh_all(config.get('github_token', None))
+
+
+@HipChat.schedule('hateb_prefetch')
+@synchronize
+@metrics.timed('hateb', 'schedule')
+async def hipchat_hateb_prefetch(config: Dict) -> None:
+    ratelimit.configure(config.get('rate_limits', {}))
+    hateb.configure(config.get('gist_cache_path',
+                               "hateb_gist_cache.sqlite3"))
+    await hateb.refresh_all(config.get('github_token', None))
@@ -2,26 +2,54 @@
 
 import requests
 import logging
+from datetime import datetime, timedelta
 from furl import furl
 import json
 from sarah.bot.hipchat import HipChat
 from sarah.bot.values import CommandMessage
+from sarah_plugins import metrics, ratelimit, transport
+from sarah_plugins.cache import TTLCache, normalize_query
 from typing import Dict
 
+# Only the resolved query and UTC offset are cached; local time itself is
+# calculated on each command so a cached entry never shows a stale clock.
+# Keep the TTL short enough to pick up DST transitions.
+timezone_cache = TTLCache(maxsize=256, ttl=3600)
+metrics.register_cache('localtime.timezone', timezone_cache)
+
+
+def format_localtime(query: str, utc_offset: str) -> str:
+    localtime = datetime.utcnow() + timedelta(hours=float(utc_offset))
+    return ('Current time at %s is %s\nUTC offset is %s' %
+            (query, localtime.strftime('%Y-%m-%d %H:%M'), utc_offset))
+
 
 @HipChat.command('.localtime')
+@metrics.timed('localtime')
 def hipchat_localtime(msg: CommandMessage, config: Dict) -> str:
+    ratelimit.configure(config.get('rate_limits', {}))
+    cache_key = normalize_query(msg.text)
+    cached_timezone = timezone_cache.get(cache_key)
+    if cached_timezone is not None:
+        return format_localtime(*cached_timezone)
+
     furl_obj = furl('https://api.worldweatheronline.com/free/v2/tz.ashx', True)
     furl_obj.add(args={'format': 'json',
                        'key': config.get('api_key', ''),
                        'q': msg.text})
 
     try:
-        response = requests.request('GET', furl_obj.url)
+        # Same API key, and so the same quota, as the .weather commands.
+        ratelimit.acquire('worldweatheronline')
+        with metrics.timer('localtime', 'upstream'):
+            response = transport.get(furl_obj.url)
 
         # Avoid "can't use a string pattern on a bytes-like object"
         # j = json.loads(response.content)
-        decoded_content = json.loads(response.content.decode())
+        with metrics.timer('localtime', 'decode'):
+            decoded_content = json.loads(response.content.decode())
+    except ratelimit.RateLimitExceeded:
+        return "Weather API is busy. Please try again later."
     except requests.HTTPError as e:
         logging.error(e)
         return 'Request error.'
@@ -42,12 +70,13 @@ def hipchat_localtime(msg: CommandMessage, config: Dict) -> str:
             return 'Malformed error message returned'
 
     try:
-        return ('Current time at %s is %s\nUTC offset is %s' %
-                (
-                    data['request'][0]['query'],
-                    data['time_zone'][0]['localtime'],
-                    data['time_zone'][0]['utcOffset']
-                ))
-    except LookupError as e:
+        query = data['request'][0]['query']
+        utc_offset = data['time_zone'][0]['utcOffset']
+        float(utc_offset)
+    except (LookupError, ValueError) as e:
         logging.error('Malformed response %s %s', e, response.content)
         return 'Malformed response'
+
+    timezone_cache.set(cache_key, (query, utc_offset), config.get('cache_ttl'))
+
+    return format_localtime(query, utc_offset)
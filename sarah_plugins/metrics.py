@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+# Shared instrumentation for plugins: latency histograms per plugin and
+# phase, error counts by type, cache hit ratios and gauges, exported as
+# Prometheus text or as a log summary.
+#
+#   with metrics.timer('hateb', 'upstream'):
+#       response = transport.get(url)
+#
+# Phases in use are "command" and "schedule" for a whole handler or
+# scheduled job, "upstream" for HTTP and API calls, "decode" for parsing
+# responses, "render" for drawing charts and "upload" for gist, plot.ly
+# and chart storage uploads.
+#
+# Recording is a perf_counter() pair, a bisect over the bucket bounds and
+# an uncontended lock per observation, so it is meant to be left on.
+import asyncio
+import functools
+import logging
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Any, Callable, Dict, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30)
+
+
+class Histogram(object):
+    def __init__(self, buckets: Sequence[float]=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+        self.__lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect_left(self.buckets, value)
+        with self.__lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+            if value > self.max:
+                self.max = value
+
+    def snapshot(self) -> Tuple[Sequence[int], float, int, float]:
+        with self.__lock:
+            return list(self.counts), self.sum, self.count, self.max
+
+    def quantile(self, q: float) -> float:
+        # Upper bound of the bucket holding the q-th observation; the
+        # overflow bucket reports the maximum seen.
+        counts, _, count, maximum = self.snapshot()
+        rank = q * count
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            if cumulative >= rank and cumulative:
+                return min(bound, maximum)
+        return maximum
+
+
+class Timer(object):
+    # Context manager measuring one phase. Errors passing through are
+    # counted by exception type and re-raised.
+    __slots__ = ('registry', 'plugin', 'phase', 'started_at')
+
+    def __init__(self, registry: 'Registry', plugin: str, phase: str):
+        self.registry = registry
+        self.plugin = plugin
+        self.phase = phase
+        self.started_at = 0.0
+
+    def __enter__(self) -> 'Timer':
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> bool:
+        self.registry.observe(self.plugin,
+                              self.phase,
+                              time.perf_counter() - self.started_at)
+        if exc_type is not None:
+            self.registry.count_error(self.plugin, self.phase, exc_type)
+        return False
+
+
+class Registry(object):
+    def __init__(self, buckets: Sequence[float]=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.__lock = threading.Lock()
+        self.__histograms = dict()
+        self.__errors = dict()
+        self.__caches = dict()
+        self.__cache_counts = dict()
+        self.__gauges = dict()
+
+    def histogram(self, plugin: str, phase: str) -> Histogram:
+        key = (plugin, phase)
+        histogram = self.__histograms.get(key, None)
+        if histogram is None:
+            with self.__lock:
+                histogram = self.__histograms.setdefault(
+                    key, Histogram(self.buckets))
+        return histogram
+
+    def observe(self, plugin: str, phase: str, seconds: float) -> None:
+        self.histogram(plugin, phase).observe(seconds)
+
+    def timer(self, plugin: str, phase: str) -> Timer:
+        return Timer(self, plugin, phase)
+
+    def timed(self, plugin: str, phase: str="command") -> Callable:
+        # Decorator for both plain functions and coroutine functions.
+        def decorator(function: Callable) -> Callable:
+            if asyncio.iscoroutinefunction(function):
+                @functools.wraps(function)
+                async def wrapper(*args, **kwargs):
+                    with self.timer(plugin, phase):
+                        return await function(*args, **kwargs)
+            else:
+                @functools.wraps(function)
+                def wrapper(*args, **kwargs):
+                    with self.timer(plugin, phase):
+                        return function(*args, **kwargs)
+            return wrapper
+
+        return decorator
+
+    def count_error(self, plugin: str, phase: str, error: Any) -> None:
+        # error is an exception, an exception class or a short label
+        if isinstance(error, BaseException):
+            error = type(error)
+        if isinstance(error, type):
+            error = error.__name__
+        key = (plugin, phase, error)
+        with self.__lock:
+            self.__errors[key] = self.__errors.get(key, 0) + 1
+
+    def register_cache(self, name: str, cache: Any) -> None:
+        # Anything with a .stats dict holding 'hits' and 'misses', e.g.
+        # TTLCache. Read only at export time.
+        with self.__lock:
+            self.__caches[name] = cache
+
+    def count_cache(self, name: str, hits: int=0, misses: int=0) -> None:
+        # For caches without their own counters, e.g. conditional GETs.
+        with self.__lock:
+            counted_hits, counted_misses = self.__cache_counts.get(name,
+                                                                   (0, 0))
+            self.__cache_counts[name] = (counted_hits + hits,
+                                         counted_misses + misses)
+
+    def register_gauge(self, name: str, read: Callable[[], float]) -> None:
+        # Current value of something, e.g. tokens left in a rate limiter.
+        # read() is called only at export time.
+        with self.__lock:
+            self.__gauges[name] = read
+
+    def gauges(self) -> Dict[str, float]:
+        with self.__lock:
+            gauges = list(self.__gauges.items())
+        return {name: read() for name, read in gauges}
+
+    def cache_stats(self) -> Dict[str, Tuple[int, int]]:
+        with self.__lock:
+            stats = dict(self.__cache_counts)
+            caches = list(self.__caches.items())
+        for name, cache in caches:
+            cache_stats = cache.stats
+            stats[name] = (cache_stats['hits'], cache_stats['misses'])
+        return stats
+
+    def error_counts(self) -> Dict[Tuple[str, str, str], int]:
+        with self.__lock:
+            return dict(self.__errors)
+
+    def histograms(self) -> Dict[Tuple[str, str], Histogram]:
+        with self.__lock:
+            return dict(self.__histograms)
+
+    def render_prometheus(self) -> str:
+        lines = ["# HELP sarah_plugin_phase_seconds "
+                 "Latency of plugin phases.",
+                 "# TYPE sarah_plugin_phase_seconds histogram"]
+        for (plugin, phase), histogram in sorted(self.histograms().items()):
+            labels = 'plugin="%s",phase="%s"' % (_escape(plugin),
+                                                 _escape(phase))
+            counts, total, count, _ = histogram.snapshot()
+            cumulative = 0
+            for bound, bucket_count in zip(histogram.buckets, counts):
+                cumulative += bucket_count
+                lines.append('sarah_plugin_phase_seconds_bucket{%s,le="%s"}'
+                             ' %d' % (labels, repr(float(bound)), cumulative))
+            lines.append('sarah_plugin_phase_seconds_bucket{%s,le="+Inf"} %d'
+                         % (labels, count))
+            lines.append('sarah_plugin_phase_seconds_sum{%s} %r' % (labels,
+                                                                     total))
+            lines.append('sarah_plugin_phase_seconds_count{%s} %d' % (labels,
+                                                                       count))
+
+        lines.append("# HELP sarah_plugin_errors_total "
+                     "Errors raised in plugin phases by type.")
+        lines.append("# TYPE sarah_plugin_errors_total counter")
+        for (plugin, phase, error), count in sorted(
+                self.error_counts().items()):
+            lines.append('sarah_plugin_errors_total'
+                         '{plugin="%s",phase="%s",type="%s"} %d' %
+                         (_escape(plugin), _escape(phase), _escape(error),
+                          count))
+
+        cache_stats = sorted(self.cache_stats().items())
+        for metric, index, description in (
+                ("sarah_cache_hits_total", 0, "Cache hits."),
+                ("sarah_cache_misses_total", 1, "Cache misses.")):
+            lines.append("# HELP %s %s" % (metric, description))
+            lines.append("# TYPE %s counter" % metric)
+            for name, counts in cache_stats:
+                lines.append('%s{cache="%s"} %d' % (metric,
+                                                    _escape(name),
+                                                    counts[index]))
+
+        lines.append("# HELP sarah_gauge Current value of plugin gauges.")
+        lines.append("# TYPE sarah_gauge gauge")
+        for name, value in sorted(self.gauges().items()):
+            lines.append('sarah_gauge{gauge="%s"} %r' % (_escape(name),
+                                                         float(value)))
+
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        lines = []
+        for (plugin, phase), histogram in sorted(self.histograms().items()):
+            _, total, count, maximum = histogram.snapshot()
+            if not count:
+                continue
+            lines.append("%s.%s: n=%d avg=%.1fms p50<=%.1fms p95<=%.1fms "
+                         "max=%.1fms" % (plugin,
+                                         phase,
+                                         count,
+                                         total / count * 1000,
+                                         histogram.quantile(0.5) * 1000,
+                                         histogram.quantile(0.95) * 1000,
+                                         maximum * 1000))
+
+        for (plugin, phase, error), count in sorted(
+                self.error_counts().items()):
+            lines.append("%s.%s error %s: %d" % (plugin, phase, error, count))
+
+        for name, (hits, misses) in sorted(self.cache_stats().items()):
+            lookups = hits + misses
+            lines.append("cache %s: hit ratio %s (%d/%d)" % (
+                name,
+                "%.2f" % (hits / lookups) if lookups else "-",
+                hits,
+                lookups))
+
+        for name, value in sorted(self.gauges().items()):
+            lines.append("gauge %s: %.2f" % (name, value))
+
+        return "\n".join(lines)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n",
+                                                                  "\\n")
+
+
+registry = Registry()
+
+
+def timer(plugin: str, phase: str) -> Timer:
+    return registry.timer(plugin, phase)
+
+
+def timed(plugin: str, phase: str="command") -> Callable:
+    return registry.timed(plugin, phase)
+
+
+def count_error(plugin: str, phase: str, error: Any) -> None:
+    registry.count_error(plugin, phase, error)
+
+
+def register_cache(name: str, cache: Any) -> None:
+    registry.register_cache(name, cache)
+
+
+def count_cache(name: str, hits: int=0, misses: int=0) -> None:
+    registry.count_cache(name, hits, misses)
+
+
+def register_gauge(name: str, read: Callable[[], float]) -> None:
+    registry.register_gauge(name, read)
+
+
+def render_prometheus() -> str:
+    return registry.render_prometheus()
+
+
+def log_summary() -> None:
+    summary = registry.summary()
+    if summary:
+        logging.info("Plugin metrics\n%s", summary)
+
+
+_lock = threading.Lock()
+_servers = dict()
+
+
+def serve(port: int, host: str="127.0.0.1") -> HTTPServer:
+    # Expose render_prometheus() at /metrics for a Prometheus scraper. Only
+    # one server is started per address, so calling this again is a no-op.
+    key = (host, port)
+    with _lock:
+        server = _servers.get(key, None)
+        if server is None:
+            server = HTTPServer((host, port), _MetricsHandler)
+            thread = threading.Thread(target=server.serve_forever,
+                                      name="sarah_plugins.metrics")
+            thread.daemon = True
+            thread.start()
+            _servers[key] = server
+    return server
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = render_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
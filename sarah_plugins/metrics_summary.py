@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+import logging
+from sarah.bot.hipchat import HipChat
+from sarah.bot.slack import Slack
+from sarah_plugins import metrics
+from typing import Dict
+
+
+def report(config: Dict) -> None:
+    # Starts the Prometheus endpoint on the first run when a port is
+    # configured, and logs a summary of every metric on each run.
+    port = config.get('prometheus_port', None)
+    if port:
+        try:
+            metrics.serve(int(port), config.get('prometheus_host',
+                                                "127.0.0.1"))
+        except Exception as e:
+            logging.error("Failed to start metrics endpoint. %s", e)
+
+    metrics.log_summary()
+
+
+# Opt-in. Enable one of these schedules, e.g. every 10 minutes.
+@Slack.schedule('metrics_summary')
+def slack_metrics_summary(config: Dict) -> None:
+    report(config)
+
+
+@HipChat.schedule('metrics_summary')
+def hipchat_metrics_summary(config: Dict) -> None:
+    report(config)
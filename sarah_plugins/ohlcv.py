@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+from operator import itemgetter
+import numpy as np
+from typing import Dict, Optional, Sequence
+
+
+class OHLCV(object):
+    # Columnar daily price history in chronological order. Each column is a
+    # NumPy array so indicators are computed without Python-level loops.
+    __slots__ = ('dates', 'open', 'high', 'low', 'close', 'volume')
+
+    def __init__(self,
+                 dates: np.ndarray,
+                 open_: np.ndarray,
+                 high: np.ndarray,
+                 low: np.ndarray,
+                 close: np.ndarray,
+                 volume: np.ndarray):
+        self.dates = dates
+        self.open = open_
+        self.high = high
+        self.low = low
+        self.close = close
+        self.volume = volume
+
+    @classmethod
+    def from_results(cls,
+                     results: Sequence[Dict],
+                     date_key: str='tradingDay') -> 'OHLCV':
+        # Barchart's getHistory results, in any order.
+        dates = np.array([r[date_key] for r in results], dtype=str)
+        values = np.array(
+            list(map(itemgetter('open', 'high', 'low', 'close', 'volume'),
+                     results)),
+            dtype=np.float64).reshape(-1, 5)
+
+        order = np.argsort(dates, kind='mergesort')
+        values = values[order]
+        return cls(dates[order],
+                   values[:, 0],
+                   values[:, 1],
+                   values[:, 2],
+                   values[:, 3],
+                   values[:, 4])
+
+    def __len__(self) -> int:
+        return len(self.dates)
+
+    def moving_average(self, window: int) -> np.ndarray:
+        # Simple moving average of close prices; one value per full window.
+        if len(self) < window:
+            return np.empty(0)
+        cumulative = np.cumsum(np.insert(self.close, 0, 0.0))
+        return (cumulative[window:] - cumulative[:-window]) / window
+
+    def vwap(self) -> Optional[float]:
+        # Volume weighted average of the typical (high + low + close) / 3
+        total_volume = self.volume.sum()
+        if not total_volume:
+            return None
+        typical_prices = (self.high + self.low + self.close) / 3
+        return float(np.dot(typical_prices, self.volume) / total_volume)
+
+    def daily_returns(self) -> np.ndarray:
+        return np.diff(self.close) / self.close[:-1]
+
+    def volatility(self, periods_per_year: int=252) -> Optional[float]:
+        # Annualized standard deviation of daily returns
+        returns = self.daily_returns()
+        if len(returns) < 2:
+            return None
+        return float(returns.std(ddof=1) * np.sqrt(periods_per_year))
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+# Token buckets in front of the metered upstream APIs, one per provider and
+# shared by every plugin, thread and coroutine calling that provider.
+import asyncio
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from sarah_plugins import metrics
+from typing import Dict, Optional
+
+# Same names as the metrics phases of handlers and scheduled jobs
+COMMAND = 'command'
+SCHEDULE = 'schedule'
+
+
+class RateLimitExceeded(Exception):
+    pass
+
+
+class TokenBucket(object):
+    # One token per request, refilled at rate per second. Scheduled jobs
+    # leave `reserve` tokens to commands and yield to waiting commands.
+    def __init__(self,
+                 rate: float,
+                 capacity: float,
+                 reserve: float=0,
+                 max_wait: float=2,
+                 schedule_max_wait: float=30):
+        self.__lock = threading.Lock()
+        self.__tokens = float(capacity)
+        self.__updated_at = time.monotonic()
+        self.__waiting_commands = 0
+        self.configure(rate, capacity, reserve, max_wait, schedule_max_wait)
+
+    def configure(self,
+                  rate: float,
+                  capacity: float,
+                  reserve: float=0,
+                  max_wait: float=2,
+                  schedule_max_wait: float=30) -> None:
+        # Tokens already in the bucket are kept, up to the new capacity.
+        # A scheduled take needs 1 + reserve tokens, so a larger reserve
+        # would starve scheduled jobs forever.
+        if rate <= 0 or capacity < 1 or not 0 <= reserve <= capacity - 1:
+            raise ValueError("rate must be positive, capacity at least 1 "
+                             "and reserve between 0 and capacity - 1")
+
+        with self.__lock:
+            self.rate = float(rate)
+            self.capacity = float(capacity)
+            self.reserve = float(reserve)
+            self.max_wait = float(max_wait)
+            self.schedule_max_wait = float(schedule_max_wait)
+            self.__tokens = min(self.__tokens, self.capacity)
+
+    def __refill(self) -> None:
+        now = time.monotonic()
+        self.__tokens = min(self.capacity,
+                            self.__tokens +
+                            (now - self.__updated_at) * self.rate)
+        self.__updated_at = now
+
+    @property
+    def level(self) -> float:
+        with self.__lock:
+            self.__refill()
+            return self.__tokens
+
+    @property
+    def waiting(self) -> int:
+        return self.__waiting_commands
+
+    def take(self, priority: str=COMMAND) -> float:
+        # Takes a token and returns 0, or returns how long to wait before
+        # one is available to this caller.
+        with self.__lock:
+            self.__refill()
+            required = 1.0
+            if priority != COMMAND:
+                required += self.reserve + self.__waiting_commands
+
+            if self.__tokens >= required:
+                self.__tokens -= 1
+                return 0
+            return (required - self.__tokens) / self.rate
+
+    @contextmanager
+    def __waiting(self, priority: str):
+        if priority != COMMAND:
+            yield
+            return
+
+        with self.__lock:
+            self.__waiting_commands += 1
+        try:
+            yield
+        finally:
+            with self.__lock:
+                self.__waiting_commands -= 1
+
+    def __deadline(self, priority: str, max_wait: float=None) -> float:
+        # max_wait lets a caller with its own time budget wait less.
+        configured = self.max_wait if priority == COMMAND \
+            else self.schedule_max_wait
+        if max_wait is not None:
+            configured = min(configured, max_wait)
+        return time.monotonic() + configured
+
+    def acquire(self, priority: str=COMMAND, max_wait: float=None) -> None:
+        deadline = self.__deadline(priority, max_wait)
+        delay = self.take(priority)
+        if not delay:
+            return
+
+        with self.__waiting(priority):
+            while delay:
+                if time.monotonic() + delay > deadline:
+                    raise RateLimitExceeded(
+                        "Next token in %.1f seconds" % delay)
+                time.sleep(delay)
+                delay = self.take(priority)
+
+    async def acquire_async(self,
+                            priority: str=COMMAND,
+                            max_wait: float=None) -> None:
+        deadline = self.__deadline(priority, max_wait)
+        delay = self.take(priority)
+        if not delay:
+            return
+
+        with self.__waiting(priority):
+            while delay:
+                if time.monotonic() + delay > deadline:
+                    raise RateLimitExceeded(
+                        "Next token in %.1f seconds" % delay)
+                await asyncio.sleep(delay)
+                delay = self.take(priority)
+
+
+class RateLimiter(object):
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__buckets = dict()
+
+    def bucket(self, provider: str) -> Optional[TokenBucket]:
+        return self.__buckets.get(provider, None)
+
+    def configure(self, limits: Dict[str, Dict]) -> None:
+        # Called with the rate_limits of a plugin's config on every run, so
+        # changed settings apply without losing the tokens left. e.g.
+        # {'worldweatheronline': {'rate': 0.2, 'capacity': 5, 'reserve': 2}}
+        for provider, settings in limits.items():
+            try:
+                with self.__lock:
+                    bucket = self.__buckets.get(provider, None)
+                    if bucket is None:
+                        bucket = TokenBucket(**settings)
+                        self.__buckets[provider] = bucket
+                        self.__publish(provider, bucket)
+                    else:
+                        bucket.configure(**settings)
+            except (TypeError, ValueError) as e:
+                logging.error("Invalid rate limit for %s. %s", provider, e)
+
+    @staticmethod
+    def __publish(provider: str, bucket: TokenBucket) -> None:
+        metrics.register_gauge("ratelimit.%s.tokens" % provider,
+                               lambda: bucket.level)
+        metrics.register_gauge("ratelimit.%s.waiting_commands" % provider,
+                               lambda: bucket.waiting)
+
+    def acquire(self,
+                provider: str,
+                priority: str=COMMAND,
+                max_wait: float=None) -> None:
+        bucket = self.bucket(provider)
+        if bucket is not None:
+            bucket.acquire(priority, max_wait)
+
+    async def acquire_async(self,
+                            provider: str,
+                            priority: str=COMMAND,
+                            max_wait: float=None) -> None:
+        bucket = self.bucket(provider)
+        if bucket is not None:
+            await bucket.acquire_async(priority, max_wait)
+
+    def levels(self) -> Dict[str, float]:
+        with self.__lock:
+            buckets = list(self.__buckets.items())
+        return {provider: bucket.level for provider, bucket in buckets}
+
+
+limiter = RateLimiter()
+
+
+def configure(limits: Dict[str, Dict]) -> None:
+    limiter.configure(limits)
+
+
+def acquire(provider: str,
+            priority: str=COMMAND,
+            max_wait: float=None) -> None:
+    limiter.acquire(provider, priority, max_wait)
+
+
+async def acquire_async(provider: str,
+                        priority: str=COMMAND,
+                        max_wait: float=None) -> None:
+    await limiter.acquire_async(provider, priority, max_wait)
+
+
+def levels() -> Dict[str, float]:
+    return limiter.levels()
@@ -1,31 +1,160 @@
 # -*- coding: utf-8 -*-
 
-import requests
 import logging
 import json
+import re
+import threading
+import time
+from collections import deque
 from sarah.bot.hipchat import HipChat
 from sarah.bot.values import CommandMessage
-from typing import Dict
+from sarah_plugins import aio, metrics
+from sarah_plugins.aio import synchronize
+from sarah_plugins.cache import AsyncRequestCoalescer
+from typing import Dict, Optional, Sequence, Tuple
+
+# (timestamp, value, message)
+Sample = Tuple[float, object, str]
+
+
+class SensorHistory(object):
+    # Ring buffer of the latest samples; the oldest fall off once full.
+    def __init__(self, maxlen: int=7 * 24 * 60):
+        self.__lock = threading.Lock()
+        self.__samples = deque(maxlen=maxlen)
+
+    def __len__(self) -> int:
+        return len(self.__samples)
+
+    def append(self, sample: Sample) -> None:
+        with self.__lock:
+            self.__samples.append(sample)
+
+    def latest(self) -> Optional[Sample]:
+        with self.__lock:
+            return self.__samples[-1] if self.__samples else None
+
+    def since(self, timestamp: float) -> Sequence[Sample]:
+        with self.__lock:
+            return [s for s in self.__samples if s[0] >= timestamp]
+
+    def summary(self, timestamp: float) -> Optional[Dict[str, float]]:
+        values = []
+        for _, value, _ in self.since(timestamp):
+            try:
+                values.append(float(value))
+            except (TypeError, ValueError):
+                pass
+
+        if not values:
+            return None
+
+        return {'min': min(values),
+                'max': max(values),
+                'avg': sum(values) / len(values),
+                'count': len(values)}
+
+
+# Commands are answered from here, so the sensor sees one request per poll
+# interval however many people ask.
+sensor_history = SensorHistory()
+sensor_coalescer = AsyncRequestCoalescer()
+
+RANGE_PATTERN = re.compile(r'^\s*(\d+)\s*([mhdMHD])\s*$')
+
+RANGE_UNIT_SECONDS = {'m': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+
+
+async def sample_sensor(endpoint: str) -> Sample:
+    with metrics.timer('room_temp', 'upstream'):
+        response = await aio.get(endpoint)
+
+    # Avoid "can't use a string pattern on a bytes-like object"
+    # j = json.loads(response.content)
+    with metrics.timer('room_temp', 'decode'):
+        decoded_content = json.loads(response.content.decode())
+        sample = (time.time(),
+                  decoded_content['value'],
+                  decoded_content['message'])
+    sensor_history.append(sample)
+
+    return sample
+
+
+async def latest_sample(endpoint: str, max_age: float) -> Sample:
+    sample = sensor_history.latest()
+    if sample and time.time() - sample[0] < max_age:
+        metrics.count_cache('room_temp.sample', hits=1)
+        return sample
+
+    metrics.count_cache('room_temp.sample', misses=1)
+
+    # No poller running or it fell behind. Concurrent commands share one
+    # request to the sensor.
+    return await sensor_coalescer.call(endpoint, sample_sensor, endpoint)
+
+
+def range_summary(text: str) -> Optional[str]:
+    match = RANGE_PATTERN.match(text)
+    if not match:
+        return None
+
+    amount, unit = match.groups()
+    summary = sensor_history.summary(
+        time.time() - int(amount) * RANGE_UNIT_SECONDS[unit.lower()])
+    if summary is None:
+        return 'No samples in the last %s%s.' % (amount, unit)
+
+    return ('Last %s%s: min %.1f / max %.1f / avg %.1f (%d samples)' %
+            (amount,
+             unit,
+             summary['min'],
+             summary['max'],
+             summary['avg'],
+             summary['count']))
 
 
 @HipChat.command('.room_temp')
-def temperature(_: CommandMessage, config: Dict) -> str:
+@synchronize
+@metrics.timed('room_temp')
+async def temperature(msg: CommandMessage, config: Dict) -> str:
+    if msg.text:
+        # Computed from the buffer without touching the device.
+        return range_summary(msg.text) or (
+            'Please input a range such as 30m, 24h or 7d.')
+
+    previous_sample = sensor_history.latest()
     try:
-        response = requests.request('GET', config.get('endpoint', ''))
-    except requests.HTTPError as e:
-        logging.error(e)
-        return 'Request error.'
+        sample = await latest_sample(config.get('endpoint', ''),
+                                     config.get('max_age', 300))
     except Exception as e:
         logging.error(e)
-        return 'Unknown error occurred.'
+        # Already loaded by sarah_plugins.aio once a request is made.
+        import aiohttp
+        if previous_sample:
+            # Better an old reading than an error.
+            return '%s\n%s\n(%d seconds ago)' % (
+                previous_sample[1],
+                previous_sample[2],
+                time.time() - previous_sample[0])
+        elif isinstance(e, aiohttp.ClientError):
+            return 'Request error.'
+        elif isinstance(e, (ValueError, LookupError)):
+            return 'Error on parsing response.'
+        else:
+            return 'Unknown error occurred.'
+
+    return '%s\n%s' % (sample[1], sample[2])
 
+
+# Background poller. Enable this schedule with the sampling interval, e.g.
+# every minute, and set the command's max_age above that interval.
+@HipChat.schedule('room_temp_poll')
+@synchronize
+@metrics.timed('room_temp', 'schedule')
+async def poll_temperature(config: Dict) -> None:
+    endpoint = config.get('endpoint', '')
     try:
-        # Avoid "can't use a string pattern on a bytes-like object"
-        # j = json.loads(response.content)
-        decoded_content = json.loads(response.content.decode())
+        await sensor_coalescer.call(endpoint, sample_sensor, endpoint)
     except Exception as e:
-        logging.error(e)
-        return 'Error on parsing response.'
-
-    return '%s\n%s' % (decoded_content['value'],
-                       decoded_content['message'])
+        logging.error("Failed to sample %s. %s", endpoint, e)
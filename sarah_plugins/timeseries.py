@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+import json
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional, Sequence, Tuple
+
+
+class TimeSeriesStore(object):
+    # Daily points keyed by (series, date). Dates are ISO 8601 strings, so
+    # lexical order is chronological order. Each point is kept as the JSON
+    # the API returned, so any source can be stored without a schema change.
+    def __init__(self, path: str):
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(path, check_same_thread=False)
+        with self.__connection:
+            self.__connection.execute(
+                "CREATE TABLE IF NOT EXISTS daily_point ("
+                "series TEXT NOT NULL, "
+                "date TEXT NOT NULL, "
+                "point TEXT NOT NULL, "
+                "PRIMARY KEY (series, date)) WITHOUT ROWID")
+            # Oldest date ever requested and time of the latest fetch, so a
+            # window starting on a holiday is not requested over and over.
+            self.__connection.execute(
+                "CREATE TABLE IF NOT EXISTS series_coverage ("
+                "series TEXT PRIMARY KEY, "
+                "covered_since TEXT NOT NULL, "
+                "fetched_at REAL NOT NULL)")
+
+    def latest_date(self, series: str) -> Optional[str]:
+        with self.__lock:
+            row = self.__connection.execute(
+                "SELECT MAX(date) FROM daily_point WHERE series = ?",
+                (series,)).fetchone()
+        return row[0]
+
+    def coverage(self, series: str) -> Tuple[Optional[str], Optional[float]]:
+        with self.__lock:
+            row = self.__connection.execute(
+                "SELECT covered_since, fetched_at FROM series_coverage "
+                "WHERE series = ?",
+                (series,)).fetchone()
+        return row if row else (None, None)
+
+    def get(self,
+            series: str,
+            start_date: str=None,
+            end_date: str=None,
+            descending: bool=False) -> Sequence[Dict]:
+        query = "SELECT point FROM daily_point WHERE series = ?"
+        params = [series]
+        if start_date:
+            query += " AND date >= ?"
+            params.append(start_date)
+        if end_date:
+            query += " AND date <= ?"
+            params.append(end_date)
+        query += " ORDER BY date %s" % ("DESC" if descending else "ASC")
+
+        with self.__lock:
+            rows = self.__connection.execute(query, params).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def put_many(self,
+                 series: str,
+                 points: Sequence[Tuple[str, Dict]],
+                 requested_since: str) -> None:
+        # Store points retrieved by a request for requested_since onwards.
+        with self.__lock, self.__connection:
+            self.__connection.executemany(
+                "INSERT OR REPLACE INTO daily_point (series, date, point) "
+                "VALUES (?, ?, ?)",
+                [(series, date, json.dumps(point, separators=(',', ':')))
+                 for date, point in points])
+
+            row = self.__connection.execute(
+                "SELECT covered_since FROM series_coverage WHERE series = ?",
+                (series,)).fetchone()
+            covered_since = min(row[0], requested_since) if row \
+                else requested_since
+            self.__connection.execute(
+                "INSERT OR REPLACE INTO series_coverage "
+                "(series, covered_since, fetched_at) VALUES (?, ?, ?)",
+                (series, covered_since, time.time()))
+
+    def close(self) -> None:
+        with self.__lock:
+            self.__connection.close()
+
+
+_lock = threading.Lock()
+_stores = dict()
+
+
+def get_store(path: str) -> TimeSeriesStore:
+    # Share one store per file among plugins and threads.
+    with _lock:
+        if path not in _stores:
+            _stores[path] = TimeSeriesStore(path)
+        return _stores[path]
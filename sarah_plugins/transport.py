@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from typing import Dict, Tuple, Union
+
+
+class HttpClient(object):
+    def __init__(self,
+                 connect_timeout: float=3.05,
+                 read_timeout: float=10,
+                 max_retries: int=2,
+                 backoff_factor: float=0.3,
+                 pool_connections: int=10,
+                 pool_maxsize: int=10,
+                 status_forcelist: Tuple[int, ...]=(500, 502, 503, 504)):
+        self.timeout = (connect_timeout, read_timeout)
+
+        # One pool per host is kept alive by requests' PoolManager, so
+        # subsequent calls to the same API skip the TCP and TLS handshakes.
+        retry = Retry(total=max_retries,
+                      backoff_factor=backoff_factor,
+                      status_forcelist=status_forcelist)
+        adapter = HTTPAdapter(pool_connections=pool_connections,
+                              pool_maxsize=pool_maxsize,
+                              max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self,
+                method: str,
+                url: str,
+                **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self,
+            url: str,
+            params: Union[Dict, str]=None,
+            **kwargs) -> requests.Response:
+        return self.request('GET', url, params=params, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request('POST', url, **kwargs)
+
+    def patch(self, url: str, **kwargs) -> requests.Response:
+        return self.request('PATCH', url, **kwargs)
+
+    def close(self) -> None:
+        self.session.close()
+
+
+_lock = threading.Lock()
+_client = None
+
+
+def get_client() -> HttpClient:
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = HttpClient()
+    return _client
+
+
+def configure(**kwargs) -> HttpClient:
+    # Replace the shared client. Accepts the same keyword arguments as
+    # HttpClient so timeouts and pool sizes can be tuned at bot startup.
+    global _client
+    with _lock:
+        old_client = _client
+        _client = HttpClient(**kwargs)
+    if old_client:
+        old_client.close()
+    return _client
+
+
+def request(method: str, url: str, **kwargs) -> requests.Response:
+    return get_client().request(method, url, **kwargs)
+
+
+def get(url: str,
+        params: Union[Dict, str]=None,
+        **kwargs) -> requests.Response:
+    return get_client().get(url, params=params, **kwargs)
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    return get_client().post(url, **kwargs)
+
+
+def patch(url: str, **kwargs) -> requests.Response:
+    return get_client().patch(url, **kwargs)
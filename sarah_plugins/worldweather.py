@@ -1,6 +1,5 @@
 # -*- coding: utf-8 -*-
 
-import requests
 import logging
 from furl import furl
 import json
@@ -8,70 +7,162 @@ from sarah.bot.hipchat import HipChat
 from sarah.bot.slack import SlackMessage, Slack, MessageAttachment, \
     AttachmentField
 from sarah.bot.values import CommandMessage
-from typing import Dict
+from sarah_plugins import aio, breaker, metrics, ratelimit
+from sarah_plugins.aio import synchronize
+from sarah_plugins.cache import TTLCache, normalize_query
+from typing import Dict, Union
+
+WEATHER_API_URL = "http://api.worldweatheronline.com/free/v2/weather.ashx"
+
+# Current conditions are shared by HipChat and Slack handlers so a city asked
+# for repeatedly in a channel costs one API call per TTL.
+current_condition_cache = TTLCache(maxsize=256, ttl=600)
+metrics.register_cache('worldweather.current_condition',
+                       current_condition_cache)
+
+
+class WeatherApiError(Exception):
+    # The API answered with an error for the query, e.g. unknown location.
+    pass
+
+
+# While the API is down, commands fail fast with the last known condition.
+weather_breaker = breaker.CircuitBreaker('worldweatheronline',
+                                         ignore=(WeatherApiError,))
 
 
 class WorldWeather(object):
     @staticmethod
-    def request(api_key: str, query: str):
-        furl_obj = furl(
-            'http://api.worldweatheronline.com/free/v2/weather.ashx', True)
+    def endpoint(api_key: str,
+                 query: str,
+                 api_url: str=WEATHER_API_URL) -> str:
+        furl_obj = furl(api_url, True)
 
         furl_obj.add(args={'format': 'json',
                            'key': api_key,
                            'q': query})
 
-        try:
-            response = requests.request('GET', furl_obj.url)
+        return furl_obj.url
 
+    @staticmethod
+    def decode(content: bytes) -> Dict:
+        try:
             # Avoid "can't use a string pattern on a bytes-like object"
             # j = json.loads(response.content)
-            decoded_content = json.loads(response.content.decode())
+            decoded_content = json.loads(content.decode())
         except Exception as e:
             logging.error(e)
             raise
 
         data = decoded_content.get('data', None)
         if data is None:
-            logging.error('Malformed response %s', response.content)
+            logging.error('Malformed response %s', content)
             raise Exception()
         elif 'error' in data:
             try:
                 logging.error(data['error'][0].get('msg', ''))
             except Exception as e:
-                logging.error("Invalid response %s %s", e, response.content)
+                logging.error("Invalid response %s %s", e, content)
             finally:
-                raise Exception()
+                raise WeatherApiError()
+
+        return data
 
+    @staticmethod
+    async def fetch(api_key: str,
+                    query: str,
+                    api_url: str=WEATHER_API_URL):
+        try:
+            with metrics.timer('worldweather', 'upstream'):
+                response = await aio.get(WorldWeather.endpoint(api_key,
+                                                               query,
+                                                               api_url))
+        except Exception as e:
+            logging.error(e)
+            raise
+
+        with metrics.timer('worldweather', 'decode'):
+            return WorldWeather.decode(response.content)
+
+    @staticmethod
+    async def request(api_key: str,
+                      query: str,
+                      ttl: float=None,
+                      api_url: str=WEATHER_API_URL,
+                      priority: str=ratelimit.COMMAND):
+        cache_key = normalize_query(query)
+        cached_data = current_condition_cache.get(cache_key)
+        if cached_data is not None:
+            return cached_data
+
+        # Waited for outside the breaker, so a request cancelled while
+        # queued for a token is not taken for an upstream failure.
+        try:
+            await ratelimit.acquire_async('worldweatheronline', priority)
+        except ratelimit.RateLimitExceeded as e:
+            data = weather_breaker.fallback(cache_key, e)
+        else:
+            data = await weather_breaker.call_async(cache_key,
+                                                    WorldWeather.fetch,
+                                                    api_key,
+                                                    query,
+                                                    api_url)
+        # A stale condition is not cached, so the next command tries again.
+        if breaker.stale_age(data) is None:
+            current_condition_cache.set(cache_key, data, ttl)
         return data
 
 
 @HipChat.command('.weather')
-def hipchat_weather(msg: CommandMessage, config: Dict) -> str:
+@synchronize
+@metrics.timed('worldweather')
+async def hipchat_weather(msg: CommandMessage, config: Dict) -> str:
+    ratelimit.configure(config.get('rate_limits', {}))
     try:
-        data = WorldWeather.request(config.get('api_key', ''), msg.text)
+        data = await WorldWeather.request(
+            config.get('api_key', ''),
+            msg.text,
+            config.get('cache_ttl', None),
+            config.get('api_url', WEATHER_API_URL))
+    except ratelimit.RateLimitExceeded:
+        return "Weather API is busy. Please try again later."
     except:
         return "Something went wrong with weather API"
     else:
         try:
             condition = data['current_condition'][0]
-            return ('Current weather at %s is %s\n'
-                    '%s degrees Celsius. %s degrees Fahrenheit.' %
-                    (
-                        data['request'][0]['query'],
-                        condition['weatherDesc'][0]['value'],
-                        condition['temp_C'],
-                        condition['temp_F']
-                    ))
+            message = ('Current weather at %s is %s\n'
+                       '%s degrees Celsius. %s degrees Fahrenheit.' %
+                       (
+                           data['request'][0]['query'],
+                           condition['weatherDesc'][0]['value'],
+                           condition['temp_C'],
+                           condition['temp_F']
+                       ))
+            age = breaker.stale_age(data)
+            if age is not None:
+                # The API is not answering; say how old this is.
+                message += '\n' + breaker.age_marker(age)
+            return message
         except LookupError as e:
             logging.error('Malformed response %s %s', e, data)
             return 'Error on parsing response.'
 
 
 @Slack.command('.weather')
-def hipchat_weather(msg: CommandMessage, config: Dict) -> str:
+@synchronize
+@metrics.timed('worldweather')
+async def slack_weather(msg: CommandMessage,
+                        config: Dict) -> Union[str, SlackMessage]:
+    ratelimit.configure(config.get('rate_limits', {}))
     try:
-        data = WorldWeather.request(config.get('api_key', ''), msg.text)
+        data = await WorldWeather.request(
+            config.get('api_key', ''),
+            msg.text,
+            config.get('cache_ttl', None),
+            config.get('api_url', WEATHER_API_URL))
+    except ratelimit.RateLimitExceeded:
+        return "Weather API is busy. Please try again later."
     except:
         return "Something went wrong with weather API"
     else:
@@ -83,6 +174,9 @@ def hipchat_weather(msg: CommandMessage, config: Dict) -> str:
             description = "Current weather at %s is %s." % (
                 data['request'][0]['query'],
                 condition['weatherDesc'][0]['value'])
+            age = breaker.stale_age(data)
+            if age is not None:
+                description += " " + breaker.age_marker(age)
 
             return SlackMessage(
                 attachments=[
@@ -170,3 +264,4 @@ def hipchat_weather(msg: CommandMessage, config: Dict) -> str:
         except LookupError as e:
             logging.error('Malformed response %s %s', e, data)
             return 'Error on parsing response.'
+
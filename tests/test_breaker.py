@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import itertools
+import unittest
+from sarah_plugins import breaker
+from sarah_plugins.breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, \
+    CircuitOpenError, StaleResponse
+
+_names = itertools.count()
+
+
+class UpstreamError(Exception):
+    pass
+
+
+class UnknownQuery(Exception):
+    pass
+
+
+def new_breaker(**kwargs) -> CircuitBreaker:
+    # Names are unique so gauges of one test don't replace another's.
+    return CircuitBreaker("test%d" % next(_names), **kwargs)
+
+
+def fail():
+    raise UpstreamError("down")
+
+
+async def fail_async():
+    raise UpstreamError("down")
+
+
+async def answer_async(response):
+    return response
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def test_opens_after_consecutive_failures(self):
+        circuit = new_breaker(failure_threshold=3, reset_timeout=60)
+        for _ in range(2):
+            with self.assertRaises(UpstreamError):
+                circuit.call('key', fail)
+        self.assertEqual(circuit.state, CLOSED)
+
+        with self.assertRaises(UpstreamError):
+            circuit.call('key', fail)
+        self.assertEqual(circuit.state, OPEN)
+
+        # Fails fast without calling the function.
+        with self.assertRaises(CircuitOpenError):
+            circuit.call('key', self.must_not_call)
+
+    def test_success_resets_failure_count(self):
+        circuit = new_breaker(failure_threshold=2)
+        with self.assertRaises(UpstreamError):
+            circuit.call('key', fail)
+        # Another key, so 'key' has no last good response to fall back to.
+        circuit.call('other', dict)
+        with self.assertRaises(UpstreamError):
+            circuit.call('key', fail)
+        self.assertEqual(circuit.state, CLOSED)
+
+    def test_serves_last_good_response_when_failing_or_open(self):
+        circuit = new_breaker(failure_threshold=1, reset_timeout=60)
+        circuit.call('key', dict, rate=1)
+
+        response = circuit.call('key', fail)
+        self.assertIsInstance(response, StaleResponse)
+        self.assertEqual(response, {'rate': 1})
+        self.assertEqual(circuit.state, OPEN)
+
+        response = circuit.call('key', self.must_not_call)
+        self.assertEqual(response, {'rate': 1})
+        self.assertIsNotNone(breaker.stale_age(response))
+
+        # Nothing stored for another key.
+        with self.assertRaises(CircuitOpenError):
+            circuit.call('other', self.must_not_call)
+
+    def test_ignored_errors_count_as_success(self):
+        circuit = new_breaker(failure_threshold=1, ignore=(UnknownQuery,))
+
+        def unknown():
+            raise UnknownQuery()
+
+        for _ in range(3):
+            with self.assertRaises(UnknownQuery):
+                circuit.call('key', unknown)
+        self.assertEqual(circuit.state, CLOSED)
+
+    def test_half_open_probe_success_closes(self):
+        circuit = new_breaker(failure_threshold=1, reset_timeout=0)
+        with self.assertRaises(UpstreamError):
+            circuit.call('key', fail)
+        self.assertEqual(circuit.state, OPEN)
+
+        self.assertEqual(circuit.call('key', dict, rate=2), {'rate': 2})
+        self.assertEqual(circuit.state, CLOSED)
+
+    def test_half_open_probe_failure_reopens(self):
+        circuit = new_breaker(failure_threshold=3, reset_timeout=0)
+        for _ in range(3):
+            with self.assertRaises(UpstreamError):
+                circuit.call('key', fail)
+
+        # A single failed probe is enough to open again.
+        with self.assertRaises(UpstreamError):
+            circuit.call('key', fail)
+        self.assertEqual(circuit.state, OPEN)
+
+    def test_one_probe_at_a_time(self):
+        circuit = new_breaker(failure_threshold=1, reset_timeout=0)
+        with self.assertRaises(UpstreamError):
+            circuit.call('key', fail)
+
+        self.assertTrue(circuit.allow())
+        self.assertEqual(circuit.state, HALF_OPEN)
+        self.assertFalse(circuit.allow())
+
+    def test_call_async_transitions(self):
+        circuit = new_breaker(failure_threshold=2, reset_timeout=0)
+        self.assertEqual(self.run_async(
+            circuit.call_async('key', answer_async, {'rate': 1})),
+            {'rate': 1})
+        for _ in range(2):
+            response = self.run_async(circuit.call_async('key', fail_async))
+            self.assertIsInstance(response, StaleResponse)
+        self.assertEqual(circuit.state, OPEN)
+
+        self.run_async(circuit.call_async('key', answer_async, {'rate': 2}))
+        self.assertEqual(circuit.state, CLOSED)
+
+    def cancel_call(self, circuit: CircuitBreaker) -> None:
+        async def hang():
+            await asyncio.Event().wait()
+
+        task = self.loop.create_task(circuit.call_async('key', hang))
+        self.run_async(asyncio.sleep(0))
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            self.run_async(task)
+
+    def test_cancelled_calls_are_not_failures(self):
+        circuit = new_breaker(failure_threshold=2)
+        self.run_async(circuit.call_async('key', answer_async, {'rate': 1}))
+        for _ in range(5):
+            # Propagated, not swallowed by a stale response.
+            self.cancel_call(circuit)
+        self.assertEqual(circuit.state, CLOSED)
+
+    def test_cancelled_probe_gives_way_to_next_caller(self):
+        circuit = new_breaker(failure_threshold=1, reset_timeout=0)
+        with self.assertRaises(UpstreamError):
+            self.run_async(circuit.call_async('key', fail_async))
+        self.assertEqual(circuit.state, OPEN)
+
+        self.cancel_call(circuit)
+        self.assertEqual(circuit.state, OPEN)
+        self.assertTrue(circuit.allow())
+
+    def must_not_call(self):
+        self.fail("Called while the circuit is open")
+
+
+if __name__ == '__main__':
+    unittest.main()
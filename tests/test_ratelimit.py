@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import time
+import unittest
+from sarah_plugins.ratelimit import COMMAND, SCHEDULE, RateLimitExceeded, \
+    TokenBucket
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_reserve_must_leave_a_token_for_schedules(self):
+        for reserve in (-1, 4.5, 5, 6):
+            with self.assertRaises(ValueError):
+                TokenBucket(rate=1, capacity=5, reserve=reserve)
+
+        bucket = TokenBucket(rate=1, capacity=5, reserve=2)
+        with self.assertRaises(ValueError):
+            bucket.configure(rate=1, capacity=5, reserve=4.5)
+        self.assertEqual(bucket.reserve, 2)
+
+    def test_largest_reserve_still_serves_full_bucket(self):
+        bucket = TokenBucket(rate=0.001, capacity=5, reserve=4,
+                             schedule_max_wait=0)
+        bucket.acquire(SCHEDULE)
+        self.assertAlmostEqual(bucket.level, 4, places=2)
+
+    def test_schedules_leave_reserve_to_commands(self):
+        bucket = TokenBucket(rate=0.001, capacity=3, reserve=1,
+                             max_wait=0, schedule_max_wait=0)
+        bucket.acquire(SCHEDULE)
+        bucket.acquire(SCHEDULE)
+        with self.assertRaises(RateLimitExceeded):
+            bucket.acquire(SCHEDULE)
+
+        bucket.acquire(COMMAND)
+        with self.assertRaises(RateLimitExceeded):
+            bucket.acquire(COMMAND)
+
+    def test_max_wait_shortens_configured_wait(self):
+        bucket = TokenBucket(rate=1, capacity=1, schedule_max_wait=30)
+        bucket.acquire(SCHEDULE)
+
+        started_at = time.monotonic()
+        with self.assertRaises(RateLimitExceeded):
+            bucket.acquire(SCHEDULE, max_wait=0.1)
+        self.assertLess(time.monotonic() - started_at, 0.5)
+
+    def test_waits_for_next_token(self):
+        bucket = TokenBucket(rate=20, capacity=1, max_wait=1)
+        bucket.acquire()
+
+        started_at = time.monotonic()
+        bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - started_at, 0.04)
+
+
+if __name__ == '__main__':
+    unittest.main()